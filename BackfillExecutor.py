@@ -0,0 +1,197 @@
+import datetime
+import queue
+import threading
+import time
+import traceback
+
+from TwitterAPI import TwitterRequestError, TwitterConnectionError, HydrateType
+
+from TwitterAPIWrapper import TwitterJSONWrapper
+from RateLimiter import RateLimiter
+import Metrics
+
+PAGES = Metrics.registry.counter('backfill_pages_total', "Search pages fetched and stored")
+STORE_SECONDS = Metrics.registry.histogram('backfill_store_seconds', "Time to store one search page")
+
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+WINDOWS = {'day': datetime.timedelta(days=1), 'hour': datetime.timedelta(hours=1)}
+
+
+# Split the range between two ISO 8601 times (2020-03-05T06:43:25Z) into consecutive windows of the given length
+# ('day', 'hour' or a timedelta). The search end_time is exclusive, so the windows don't overlap.
+def split_time_range(start_time, end_time, window):
+    if isinstance(window, str):
+        window = WINDOWS[window]
+    start = datetime.datetime.strptime(start_time, TIME_FORMAT)
+    end = datetime.datetime.strptime(end_time, TIME_FORMAT)
+    windows = []
+    while start < end:
+        window_end = min(start + window, end)
+        windows.append((start.strftime(TIME_FORMAT), window_end.strftime(TIME_FORMAT)))
+        start = window_end
+    return windows
+
+
+# Pagination state of one search query, optionally restricted to a time window. Each cursor is an independent unit
+# of work that can be retried and checkpointed.
+class QueryCursor:
+    def __init__(self, query, next_token='', start_time=None, end_time=None):
+        self.query = query
+        self.next_token = next_token
+        # None means the start_time / end_time of the metadata fields.
+        self.start_time = start_time
+        self.end_time = end_time
+        self.completed = False
+        self.failed = False
+        self.pages = 0
+        self.tweets = 0
+        self.errors = 0
+
+    def to_dict(self):
+        return {'query': self.query, 'next_token': self.next_token, 'start_time': self.start_time,
+                'end_time': self.end_time, 'completed': self.completed}
+
+    @staticmethod
+    def from_dict(values):
+        cursor = QueryCursor(values['query'], values.get('next_token', ''), values.get('start_time'),
+                             values.get('end_time'))
+        cursor.completed = values.get('completed', False)
+        return cursor
+
+
+# Paginates several search queries at once. Every query has its own QueryCursor; workers take a cursor, fetch its
+# next page, hand the parsed page to store and put the cursor back until it is completed, so all queries make
+# progress at the same time while the shared RateLimiter keeps the total request rate within the quota.
+# A cursor that fails max_errors times in a row is given up and reported as failed. checkpoint, if given, is called
+# with the cursor after each of its pages has been stored and the cursor advanced.
+# With a pool (BackfillProcessPool) the raw pages are handed to its worker processes, which parse and store them and
+# checkpoint the cursors, so the workers here only fetch; store and checkpoint are not used.
+# api only needs a request(resource, params, hydrate_type=...) method, so a local fake can stand in for TwitterAPI.
+class BackfillExecutor:
+    def __init__(self, api, metadata_fields, store, workers=4, rate_limiter: RateLimiter = None,
+                 endpoint='tweets/search/all', max_errors=10, checkpoint=None, pool=None):
+        self.api = api
+        self.metadata_fields = metadata_fields
+        self.store = store
+        self.workers = workers
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.endpoint = endpoint
+        self.max_errors = max_errors
+        self.checkpoint = checkpoint
+        self.pool = pool
+        self.request_seconds = Metrics.registry.histogram('api_request_seconds', "Time of a Twitter API request",
+                                                          {'endpoint': endpoint})
+        self.cursors = queue.Queue()
+        self.stop_event = threading.Event()
+        self.remaining = 0
+        self.lock = threading.Lock()
+        self.pages = 0
+
+    # Paginate every cursor until it is completed. Returns when all cursors are completed or on KeyboardInterrupt.
+    def run(self, cursors):
+        self.stop_event.clear()
+        self.remaining = 0
+        for cursor in cursors:
+            if not cursor.completed:
+                self.cursors.put(cursor)
+                self.remaining += 1
+        threads = [threading.Thread(target=self.__work, name=f"Backfill-{i}", daemon=True)
+                   for i in range(min(self.workers, self.remaining))]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            print("Keyboard interrupt. Stopping now")
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+        elapsed = time.monotonic() - start
+        print(f"Fetched {self.pages} pages in {elapsed:.1f}s. {self.rate_limiter.stats()}")
+        for cursor in cursors:
+            if cursor.failed:
+                print(f"Gave up on query after {cursor.errors} errors: {cursor.query} "
+                      f"({cursor.start_time} - {cursor.end_time})")
+
+    def __work(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                if self.remaining == 0:
+                    return
+            try:
+                cursor = self.cursors.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            # The pool fails a cursor when one of its pages could not be stored.
+            if not cursor.failed:
+                self.fetch_page(cursor)
+            if cursor.errors >= self.max_errors:
+                cursor.failed = True
+            if cursor.completed or cursor.failed:
+                with self.lock:
+                    self.remaining -= 1
+            else:
+                self.cursors.put(cursor)
+
+    # Fetch and store the next page of cursor and advance it. Returns the parsed page, or None with a pool.
+    def fetch_page(self, cursor: QueryCursor):
+        params = dict(self.metadata_fields)
+        params['query'] = cursor.query
+        if cursor.start_time is not None:
+            params['start_time'] = cursor.start_time
+        if cursor.end_time is not None:
+            params['end_time'] = cursor.end_time
+        if cursor.next_token:
+            params['next_token'] = cursor.next_token
+        else:
+            params.pop('next_token', None)
+        try:
+            self.rate_limiter.acquire()
+            with self.request_seconds.time():
+                r = self.api.request(self.endpoint, params, hydrate_type=HydrateType.NONE)
+                self.rate_limiter.update(r)
+                if r.status_code != 200:
+                    raise TwitterRequestError(r.status_code, r.text)
+                if self.pool is None:
+                    response = r.json()
+                else:
+                    text = r.text
+            if self.pool is None:
+                data = TwitterJSONWrapper(response)
+                with STORE_SECONDS.time():
+                    self.store(data)
+                result_count, next_token = data.result_count, data.next_token
+            else:
+                data = None
+                result_count, next_token = self.pool.page_meta(text)
+                self.pool.submit(cursor, text, next_token, not (next_token and result_count != 0))
+            PAGES.inc()
+            with self.lock:
+                self.pages += 1
+            cursor.pages += 1
+            cursor.errors = 0
+            cursor.tweets += result_count
+            if next_token and result_count != 0:
+                cursor.next_token = next_token
+            else:
+                cursor.completed = True
+            if self.checkpoint is not None and self.pool is None:
+                self.checkpoint(cursor)
+            return data
+        except TwitterRequestError as e:
+            print(e.status_code)
+            for msg in iter(e):
+                print(msg)
+            self.rate_limiter.backoff(e.status_code)
+        except TwitterConnectionError as e:
+            print(e)
+            self.rate_limiter.backoff()
+        except Exception as e:
+            print(e)
+            traceback.print_exc()
+            self.rate_limiter.backoff()
+        cursor.errors += 1
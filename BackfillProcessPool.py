@@ -0,0 +1,267 @@
+import json
+import multiprocessing
+import queue
+import re
+import threading
+import traceback
+
+from TwitterAPIWrapper import TwitterJSONWrapper
+from BackfillExecutor import QueryCursor
+import Metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PAGES_STORED = Metrics.registry.counter('backfill_pool_pages_total', "Search pages parsed and stored by worker "
+                                        "processes")
+PAGE_FAILURES = Metrics.registry.counter('backfill_pool_failures_total', "Search pages worker processes failed to "
+                                         "store")
+
+# Keys of the meta object of a search page. JSON strings can't hold an unescaped quote, so these only match the keys.
+NEXT_TOKEN = re.compile(r'"next_token"\s*:\s*"([^"]*)"')
+RESULT_COUNT = re.compile(r'"result_count"\s*:\s*(\d+)')
+
+
+# Sinks for the worker processes. Every worker creates its own sink with sink_factory(worker_name), so the factory
+# has to be picklable: a module level function, or a functools.partial of one.
+
+# A ChunkSink whose files are named after the worker, e.g. missing_tweets_w12345_0.csv, so that workers never write
+# to the same file. BulkLoader.find_backfill_files picks them up like any other backfill file.
+def chunk_sink(worker_name, file_format='csv', directory=".", max_rows=100000):
+    from ChunkSink import ChunkSink
+    return ChunkSink(file_format, directory, max_rows, tweet_prefix=f"missing_tweets_{worker_name}",
+                     user_prefix=f"missing_users_{worker_name}",
+                     keyword_prefix=f"missing_tweet_keywords_{worker_name}")
+
+
+# A BulkLoader on its own MySQL connection, writing the pages straight into the database.
+def db_sink(worker_name, credentials_file_name='db_creds.json', batch_size=10000):
+    import stream_utils
+    from DBHandler import DBHandler
+    from TweetDBHandler import TweetDBHandler
+    from BulkLoader import BulkLoader, BATCH
+    db_credentials = stream_utils.read_database_credentials(credentials_file_name)
+    TweetDBHandler.DATABASE_NAME = db_credentials['db_name']
+    db = DBHandler()
+    db.create_db_connection(db_credentials['local_host'], db_credentials['local_user'],
+                            db_credentials['local_password'], db_credentials['db_name'])
+    TweetDBHandler.create_tables(db)
+    return BulkLoader(db, BATCH, batch_size)
+
+
+# Worker process: parse the raw pages from tasks, drop duplicate tweets and unchanged profiles, tag the keywords and
+# write them to the worker's sink. Every page is answered on results with (cursor key, page number, stored, tweets,
+# users); None stops the worker, which closes its sink and answers None.
+def work(tasks, results, sink_factory, keyword_ids, deduplicate, cache_profiles):
+    import os
+    from TweetDeduplicator import TweetDeduplicator
+    from ProfileCache import ProfileCache
+    from KeywordMatcher import KeywordMatcher
+    sink = sink_factory(f"w{os.getpid()}")
+    deduplicator = TweetDeduplicator() if deduplicate else None
+    profile_cache = ProfileCache() if cache_profiles else None
+    matcher = KeywordMatcher(keyword_ids) if keyword_ids else None
+    loads = orjson.loads if orjson is not None else json.loads
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        key, page, text = task
+        try:
+            data = TwitterJSONWrapper(loads(text))
+            if deduplicator is not None:
+                deduplicator.filter(data, remember=False)
+            if profile_cache is not None:
+                profile_cache.filter_batch(data.batch, data.user_start)
+            if matcher is not None:
+                matcher.tag_batch(data.batch)
+            stored = sink.write(data.batch) is not False
+            if stored and deduplicator is not None:
+                deduplicator.remember(data.batch.tweet_columns[0])
+            if stored and profile_cache is not None:
+                profile_cache.store(data.batch.user_rows())
+            results.put((key, page, stored, data.batch.tweet_count, data.batch.user_count))
+        except Exception as e:
+            print(e)
+            traceback.print_exc()
+            results.put((key, page, False, 0, 0))
+    sink.close()
+    results.put(None)
+
+
+# Pagination progress of one cursor whose pages are stored by the pool.
+class CursorProgress:
+    def __init__(self, cursor: QueryCursor):
+        self.cursor = cursor
+        self.pages = 0
+        # Page number of the next page to checkpoint, and the (next_token, completed) after every stored page.
+        self.next_page = 0
+        self.stored = {}
+        self.failed = False
+
+
+# Parses and stores raw search pages in worker processes, so that parsing runs outside the GIL of the process that
+# fetches. submit() queues the raw text of a page and blocks while max_pending pages are waiting, which keeps the
+# fetchers from running ahead of the workers.
+# Workers run in parallel, so the pages of a cursor can be stored out of order. A cursor is only checkpointed up to
+# the last page that has been stored with all the pages before it. If a page can't be stored, its cursor is marked
+# as failed and isn't checkpointed any further, so a resumed backfill fetches that page again.
+# If a worker process dies, e.g. because sink_factory raised, the pool is broken: the cursors with pages in flight
+# and every cursor submitted afterwards are failed instead of waiting for workers that will never answer.
+# Duplicate tweets and unchanged profiles are only filtered within each worker; tweets are inserted with INSERT
+# IGNORE, so duplicates across workers are dropped when they are loaded.
+class BackfillProcessPool:
+    def __init__(self, sink_factory=chunk_sink, processes=None, keyword_ids=None, checkpoint=None, max_pending=None,
+                 deduplicate=True, cache_profiles=True):
+        processes = processes if processes is not None else multiprocessing.cpu_count()
+        # spawn, since forking a process that runs threads can leave locks held in the child.
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue(max_pending if max_pending is not None else 2 * processes)
+        self.results = context.Queue()
+        self.checkpoint = checkpoint
+        self.lock = threading.Lock()
+        self.progress = {}
+        self.submitted = 0
+        self.pages_stored = 0
+        self.failures = 0
+        self.tweets_written = 0
+        self.users_written = 0
+        self.closing = False
+        self.broken = False
+        keyword_ids = dict(keyword_ids) if keyword_ids else None
+        self.processes = [context.Process(target=work, args=(self.tasks, self.results, sink_factory, keyword_ids,
+                                                             deduplicate, cache_profiles),
+                                          name=f"BackfillWorker-{i}", daemon=True)
+                          for i in range(processes)]
+        for process in self.processes:
+            process.start()
+        self.collector = threading.Thread(target=self.__collect, name="BackfillCollector", daemon=True)
+        self.collector.start()
+
+    # result_count and next_token of a raw search page, without decoding it. meta is the last key Twitter sends.
+    @staticmethod
+    def page_meta(text):
+        meta = max(text.rfind('"meta"'), 0)
+        result_count = RESULT_COUNT.search(text, meta)
+        next_token = NEXT_TOKEN.search(text, meta)
+        return (int(result_count.group(1)) if result_count else 1,
+                next_token.group(1) if next_token else None)
+
+    # Queue a page of cursor for storing. next_token and completed are the state of the cursor after the page, which
+    # is checkpointed once the page and the ones before it have been stored. If the pool is broken the cursor is
+    # failed instead.
+    def submit(self, cursor: QueryCursor, text, next_token, completed):
+        with self.lock:
+            progress = self.progress.get(id(cursor))
+            if progress is None:
+                progress = self.progress[id(cursor)] = CursorProgress(cursor)
+            page = progress.pages
+            progress.pages += 1
+            progress.stored[page] = (next_token, completed, None)
+            self.submitted += 1
+        if not self.__put((id(cursor), page, text)):
+            with self.lock:
+                if not progress.failed:
+                    self.failures += 1
+                    PAGE_FAILURES.inc()
+                    self.__fail(progress)
+
+    # Put item on the task queue, waiting while it is full. Returns False if the pool is broken.
+    def __put(self, item):
+        while not self.broken:
+            try:
+                self.tasks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                self.__check_workers()
+        return False
+
+    # Returns True if the pool is broken, i.e. a worker process has exited before close() asked it to.
+    def __check_workers(self):
+        if self.broken:
+            return True
+        dead = [process for process in self.processes
+                if process.exitcode is not None and (process.exitcode != 0 or not self.closing)]
+        if not dead:
+            return False
+        with self.lock:
+            self.broken = True
+            print(f"Backfill worker {dead[0].name} exited with code {dead[0].exitcode}, failing the queued pages")
+            for progress in self.progress.values():
+                lost = sum(1 for _, _, stored in progress.stored.values() if stored is None)
+                if lost and not progress.failed:
+                    self.failures += lost
+                    PAGE_FAILURES.inc(lost)
+                    self.__fail(progress)
+        # Pages no worker will read must not keep this process from exiting.
+        self.tasks.cancel_join_thread()
+        return True
+
+    def __fail(self, progress: CursorProgress):
+        if progress.failed:
+            return
+        progress.failed = True
+        progress.cursor.failed = True
+        print(f"Could not store page {progress.next_page} of query: {progress.cursor.query} "
+              f"({progress.cursor.start_time} - {progress.cursor.end_time})")
+
+    def __collect(self):
+        running = len(self.processes)
+        while running:
+            try:
+                result = self.results.get(timeout=0.5)
+            except queue.Empty:
+                if self.__check_workers() and not any(process.is_alive() for process in self.processes):
+                    return
+                continue
+            if result is None:
+                running -= 1
+                continue
+            key, page, stored, tweets, users = result
+            with self.lock:
+                progress = self.progress[key]
+                next_token, completed, _ = progress.stored[page]
+                progress.stored[page] = (next_token, completed, stored)
+                if stored:
+                    self.pages_stored += 1
+                    self.tweets_written += tweets
+                    self.users_written += users
+                    PAGES_STORED.inc()
+                else:
+                    self.failures += 1
+                    PAGE_FAILURES.inc()
+                checkpoints = self.__advance(progress)
+            if self.checkpoint is not None:
+                for checkpoint in checkpoints:
+                    try:
+                        self.checkpoint(checkpoint)
+                    except Exception as e:
+                        print(e)
+                        traceback.print_exc()
+
+    # Returns the checkpoint of the cursor after the pages that have now been stored in order.
+    def __advance(self, progress: CursorProgress):
+        last = None
+        while not progress.failed and progress.stored.get(progress.next_page, (None, None, None))[2] is not None:
+            next_token, completed, stored = progress.stored.pop(progress.next_page)
+            if not stored:
+                self.__fail(progress)
+                break
+            progress.next_page += 1
+            last = QueryCursor(progress.cursor.query, next_token or '', progress.cursor.start_time,
+                               progress.cursor.end_time)
+            last.completed = completed
+        return [] if last is None else [last]
+
+    # Wait until every submitted page has been stored, stop the workers and close their sinks.
+    def close(self):
+        self.closing = True
+        for _ in self.processes:
+            self.__put(None)
+        self.collector.join()
+        for process in self.processes:
+            process.join()
+        print(f"Pages stored by {len(self.processes)} processes: {self.pages_stored} of {self.submitted}, "
+              f"failed: {self.failures}. Tweets written: {self.tweets_written}, Users written: {self.users_written}")
@@ -0,0 +1,266 @@
+import argparse
+import csv
+import glob
+import gzip
+import os
+import re
+import tempfile
+import time
+import traceback
+
+from mysql.connector import Error
+
+from TwitterAPIWrapper import TweetBatch, TWEET_COLUMNS, USER_COLUMNS, KEYWORD_COLUMNS
+from TweetDBHandler import TweetDBHandler
+from DBHandler import DBHandler
+import stream_utils
+
+INFILE = 'infile'
+BATCH = 'batch'
+# Columns the parser leaves empty, which are written to CSV as '' and loaded back as NULL.
+NULLABLE_COLUMNS = {'latitude', 'longitude', 'place_country', 'place_name', 'place_type'}
+
+
+def file_index(file_name):
+    match = re.search(r"_(\d+)\.", os.path.basename(file_name))
+    return int(match.group(1)) if match else -1
+
+
+# The backfill files in directory, tweets first, each kind in the order they were written.
+def find_backfill_files(directory=".", tweet_prefix="missing_tweets", user_prefix="missing_users",
+                        keyword_prefix="missing_tweet_keywords"):
+    files = []
+    for prefix in (tweet_prefix, user_prefix, keyword_prefix):
+        names = [name for extension in ("csv", "csv.gz", "parquet")
+                 for name in glob.glob(os.path.join(directory, f"{prefix}_*.{extension}"))]
+        files.extend(sorted(names, key=file_index))
+    return files
+
+
+# Loads backfill output into MySQL in bulk. Tweets and tweet keywords that are already stored are skipped
+# (INSERT IGNORE) and profiles are replaced, so when a user appears more than once the row written last wins; files
+# are therefore loaded in the order they were written.
+# infile: every CSV file is loaded with one LOAD DATA LOCAL INFILE statement and committed once. Needs
+# allow_local_infile=True on the connection and local_infile enabled on the server.
+# batch: rows are inserted with executemany in batches of batch_size rows. A file is committed every
+# commit_every batches, or once at its end when commit_every is None.
+# write(batch) loads backfill pages directly, so a BulkLoader can be used as the sink of OldTweetGetter. Every
+# write is committed before it returns, so the sink is always durable.
+class BulkLoader:
+    durable = True
+
+    def __init__(self, db_handler: DBHandler, mode=BATCH, batch_size=10000, commit_every=None):
+        if mode not in (INFILE, BATCH):
+            raise ValueError(f"Unknown bulk load mode: {mode}")
+        self.db_handler = db_handler
+        self.mode = mode
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.tweets_written = 0
+        self.users_written = 0
+        self.keywords_written = 0
+        self.elapsed = 0.0
+
+    @staticmethod
+    def table(columns):
+        if tuple(columns) == TWEET_COLUMNS:
+            return 'tweets'
+        if tuple(columns) == USER_COLUMNS:
+            return 'twitter_profiles'
+        if tuple(columns) == KEYWORD_COLUMNS:
+            return 'tweet_keywords'
+        raise ValueError(f"Unknown columns: {columns}")
+
+    @staticmethod
+    def insert_query(columns):
+        table = BulkLoader.table(columns)
+        insert = "REPLACE" if table == 'twitter_profiles' else "INSERT IGNORE"
+        return (f"{insert} INTO {TweetDBHandler.DATABASE_NAME}.{table} ({', '.join(columns)}) "
+                f"VALUES ({','.join(['%s'] * len(columns))})")
+
+    # Load one missing_tweets / missing_users file (csv, csv.gz or parquet). Returns the number of rows loaded.
+    def load_file(self, file_name):
+        start = time.perf_counter()
+        print(f"Loading {file_name}")
+        if self.mode == INFILE and not file_name.endswith(".parquet"):
+            rows = self.__load_infile(file_name)
+        else:
+            columns, rows = BulkLoader.read_rows(file_name)
+            rows = self.__load_rows(columns, rows)
+        elapsed = time.perf_counter() - start
+        self.elapsed += elapsed
+        print(f"{rows} rows in {elapsed:.1f}s, {rows / elapsed if elapsed else 0:,.0f} rows/sec")
+        return rows
+
+    def load_files(self, file_names):
+        for file_name in file_names:
+            try:
+                self.load_file(file_name)
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+        self.print_summary()
+
+    # Load the tweets, users and tweet keywords of a TweetBatch, e.g. a page from the BackfillExecutor. Returns True
+    # if every row was committed.
+    def write(self, batch: TweetBatch):
+        start = time.perf_counter()
+        committed = (self.__load_rows(TWEET_COLUMNS, batch.tweet_rows()) == batch.tweet_count
+                     and self.__load_rows(USER_COLUMNS, batch.user_rows()) == batch.user_count
+                     and self.__load_rows(KEYWORD_COLUMNS, batch.keyword_rows()) == batch.keyword_count)
+        self.elapsed += time.perf_counter() - start
+        return committed
+
+    def close(self):
+        self.print_summary()
+
+    def print_summary(self):
+        rows = self.tweets_written + self.users_written + self.keywords_written
+        print(f"Tweets loaded: {self.tweets_written}, Users loaded: {self.users_written}, "
+              f"Tweet keywords loaded: {self.keywords_written}, "
+              f"{rows / self.elapsed if self.elapsed else 0:,.0f} rows/sec")
+
+    def __count(self, columns, rows):
+        table = BulkLoader.table(columns)
+        if table == 'tweets':
+            self.tweets_written += rows
+        elif table == 'twitter_profiles':
+            self.users_written += rows
+        else:
+            self.keywords_written += rows
+
+    # Returns the header and an iterator over the rows of a backfill file. Empty values of NULLABLE_COLUMNS are
+    # read as None.
+    @staticmethod
+    def read_rows(file_name):
+        if file_name.endswith(".parquet"):
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(file_name)
+            return table.column_names, zip(*(table.column(name).to_pylist() for name in table.column_names))
+        file = gzip.open(file_name, "rt", newline="", encoding="utf-8") if file_name.endswith(".gz") else \
+            open(file_name, "r", newline="", encoding="utf-8")
+        reader = csv.reader(file)
+        columns = next(reader)
+        nullable = [i for i, column in enumerate(columns) if column in NULLABLE_COLUMNS]
+
+        def rows():
+            with file:
+                for row in reader:
+                    for i in nullable:
+                        if row[i] == '':
+                            row[i] = None
+                    yield row
+
+        return columns, rows()
+
+    # Insert rows with executemany in batches of batch_size on one connection, committing every commit_every
+    # batches. Returns the number of rows committed.
+    def __load_rows(self, columns, rows):
+        query = BulkLoader.insert_query(columns)
+        committed = 0
+        pending = 0
+        batches = 0
+        with self.db_handler.get_connection() as connection:
+            cursor = connection.cursor()
+            try:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= self.batch_size:
+                        cursor.executemany(query, batch)
+                        pending += len(batch)
+                        batches += 1
+                        batch = []
+                        if self.commit_every is not None and batches % self.commit_every == 0:
+                            connection.commit()
+                            committed += pending
+                            pending = 0
+                if batch:
+                    cursor.executemany(query, batch)
+                    pending += len(batch)
+                connection.commit()
+                committed += pending
+            except Error as e:
+                print(f"The error '{e}' occurred")
+                connection.rollback()
+            finally:
+                cursor.close()
+        self.__count(columns, committed)
+        return committed
+
+    # LOAD DATA LOCAL INFILE reads the CSV as written by ChunkSink or pandas. Empty values of NULLABLE_COLUMNS are
+    # loaded as NULL. csv.gz files are decompressed to a temporary file first.
+    def __load_infile(self, file_name):
+        temp_file_name = None
+        if file_name.endswith(".gz"):
+            columns, rows = BulkLoader.read_rows(file_name)
+            with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", encoding="utf-8",
+                                             delete=False) as temp_file:
+                writer = csv.writer(temp_file)
+                writer.writerow(columns)
+                writer.writerows(rows)
+                temp_file_name = temp_file.name
+            file_name = temp_file_name
+        try:
+            with open(file_name, "r", newline="", encoding="utf-8") as file:
+                header = file.readline()
+            columns = next(csv.reader([header]))
+            line_end = "\\r\\n" if header.endswith("\r\n") else "\\n"
+            table = BulkLoader.table(columns)
+            duplicates = "REPLACE" if table == 'twitter_profiles' else "IGNORE"
+            targets = [f"@{column}" if column in NULLABLE_COLUMNS else column for column in columns]
+            nulls = [f"{column} = NULLIF(@{column}, '')" for column in columns if column in NULLABLE_COLUMNS]
+            query = (f"LOAD DATA LOCAL INFILE %s {duplicates} INTO TABLE {TweetDBHandler.DATABASE_NAME}.{table} "
+                     f"CHARACTER SET utf8mb4 FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+                     f"LINES TERMINATED BY '{line_end}' IGNORE 1 LINES ({', '.join(targets)})")
+            if nulls:
+                query += " SET " + ", ".join(nulls)
+            rows = 0
+            with self.db_handler.get_connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(query, (os.path.abspath(file_name),))
+                    rows = cursor.rowcount
+                    connection.commit()
+                except Error as e:
+                    print(f"The error '{e}' occurred")
+                    connection.rollback()
+                    rows = 0
+                finally:
+                    cursor.close()
+            self.__count(columns, rows)
+            return rows
+        finally:
+            if temp_file_name is not None:
+                os.remove(temp_file_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load missing_tweets_N / missing_users_N / "
+                                                 "missing_tweet_keywords_N backfill files into MySQL.")
+    parser.add_argument('files', nargs='*', help="files to load, by default every backfill file in --directory")
+    parser.add_argument('--directory', default=".", help="directory of the backfill files")
+    parser.add_argument('--mode', choices=(INFILE, BATCH), default=BATCH,
+                        help="LOAD DATA LOCAL INFILE, or batched INSERT IGNORE / REPLACE statements")
+    parser.add_argument('--batch-size', type=int, default=10000, help="rows per executemany in batch mode")
+    parser.add_argument('--commit-every', type=int, default=None,
+                        help="commit every N batches instead of once per file")
+    args = parser.parse_args()
+
+    db_credentials = stream_utils.read_database_credentials('db_creds.json')
+    TweetDBHandler.DATABASE_NAME = db_credentials['db_name']
+    db = DBHandler()
+    db.create_db_connection(db_credentials['local_host'], db_credentials['local_user'],
+                            db_credentials['local_password'], db_credentials['db_name'],
+                            allow_local_infile=args.mode == INFILE)
+    # Creates tweet_keywords and the indexes on databases set up before they were added.
+    TweetDBHandler.create_tables(db)
+    files = args.files if args.files else find_backfill_files(args.directory)
+    print(f"Loading {len(files)} files")
+    loader = BulkLoader(db, args.mode, args.batch_size, args.commit_every)
+    loader.load_files(files)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+import threading
+
+from BackfillExecutor import QueryCursor
+
+
+# Durable backfill progress: the next_token and completed flag of every (query, time window) work unit, kept in a
+# JSON file. Every save writes a temporary file, fsyncs it and renames it over the old one, so a crash leaves either
+# the old or the new checkpoints, never a partial file.
+class CheckpointStore:
+    def __init__(self, file_name="checkpoints.json"):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.checkpoints = {}
+        if os.path.isfile(file_name):
+            with open(file_name, "r") as file:
+                self.checkpoints = json.load(file)
+
+    @staticmethod
+    def key(cursor: QueryCursor):
+        text = json.dumps([cursor.query, cursor.start_time, cursor.end_time])
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    # Load the saved progress into cursor. Returns True if there was any.
+    def restore(self, cursor: QueryCursor):
+        with self.lock:
+            checkpoint = self.checkpoints.get(CheckpointStore.key(cursor))
+        if checkpoint is None:
+            return False
+        cursor.next_token = checkpoint['next_token']
+        cursor.completed = checkpoint['completed']
+        return True
+
+    def save(self, cursors):
+        with self.lock:
+            for cursor in cursors:
+                self.checkpoints[CheckpointStore.key(cursor)] = cursor.to_dict()
+            temp_file_name = self.file_name + ".tmp"
+            with open(temp_file_name, "w") as file:
+                json.dump(self.checkpoints, file, indent=1)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file_name, self.file_name)
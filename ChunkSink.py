@@ -0,0 +1,146 @@
+import csv
+import gzip
+import io
+import os
+import re
+
+from TwitterAPIWrapper import TweetBatch, TWEET_COLUMNS, USER_COLUMNS, KEYWORD_COLUMNS
+
+CSV = 'csv'
+CSV_GZ = 'csv.gz'
+PARQUET = 'parquet'
+# Parquet column types, every other column is a string.
+PARQUET_TYPES = {'isRetweet': 'int8', 'latitude': 'float64', 'longitude': 'float64', 'friendsCount': 'int64',
+                 'followersCount': 'int64', 'statusesCount': 'int64', 'keywordId': 'int64'}
+
+
+# Returns the next unused index N for files named {prefix}_N.{extension} in directory, scanning it once.
+def next_file_index(prefix, extension, directory="."):
+    pattern = re.compile(rf"{re.escape(prefix)}_(\d+)\.{re.escape(extension)}$")
+    indexes = [int(match.group(1)) for match in map(pattern.match, os.listdir(directory)) if match]
+    return max(indexes) + 1 if indexes else 0
+
+
+# Appends rows to numbered chunk files {prefix}_N.{format} and starts a new file when the current one reaches
+# max_rows rows or max_bytes bytes.
+# csv: the file stays open and is flushed after every write.
+# csv.gz: every write is appended as a complete gzip member, which gzip readers concatenate.
+# parquet: every write is a row group of the open file. The file is only readable once it is closed (on rotation
+# or close()), so a crash loses the current chunk; keep max_rows small if that matters. Needs pyarrow.
+class ChunkWriter:
+    def __init__(self, prefix, columns, file_format=CSV, directory=".", max_rows=100000, max_bytes=256 << 20):
+        if file_format not in (CSV, CSV_GZ, PARQUET):
+            raise ValueError(f"Unknown chunk file format: {file_format}")
+        self.prefix = prefix
+        self.columns = list(columns)
+        self.file_format = file_format
+        self.directory = directory
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.index = next_file_index(prefix, file_format, directory)
+        self.file = None
+        self.file_name = None
+        self.rows = 0
+        self.bytes = 0
+        self.total_rows = 0
+        self.files = []
+        self.schema = None
+        if file_format == PARQUET:
+            import pyarrow
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema([(column, pyarrow.type_for_alias(PARQUET_TYPES.get(column, 'string')))
+                                          for column in self.columns])
+
+    # Write rows given as one list per column.
+    def write(self, columns):
+        count = len(columns[0])
+        if count == 0:
+            return
+        if self.file_name is None:
+            self.__open()
+        if self.file_format == CSV:
+            self.bytes += self.file.write(self.__csv_text(columns, self.rows == 0))
+            self.file.flush()
+        elif self.file_format == CSV_GZ:
+            data = gzip.compress(self.__csv_text(columns, self.rows == 0).encode("utf-8"))
+            with open(self.file_name, "ab") as file:
+                file.write(data)
+            self.bytes += len(data)
+        else:
+            table = self.pyarrow.table(dict(zip(self.columns, columns)), schema=self.schema)
+            self.file.write_table(table)
+            self.bytes += table.nbytes
+        self.rows += count
+        self.total_rows += count
+        if self.rows >= self.max_rows or self.bytes >= self.max_bytes:
+            self.close()
+
+    def __csv_text(self, columns, header):
+        text = io.StringIO()
+        writer = csv.writer(text)
+        if header:
+            writer.writerow(self.columns)
+        writer.writerows(zip(*columns))
+        return text.getvalue()
+
+    def __open(self):
+        self.file_name = os.path.join(self.directory, f"{self.prefix}_{self.index}.{self.file_format}")
+        self.index += 1
+        self.rows = 0
+        self.bytes = 0
+        self.files.append(self.file_name)
+        print(f"Writing {self.file_name}")
+        if self.file_format == CSV:
+            self.file = open(self.file_name, "w", newline="", encoding="utf-8")
+        elif self.file_format == PARQUET:
+            import pyarrow.parquet
+            self.file = pyarrow.parquet.ParquetWriter(self.file_name, self.schema, compression="snappy")
+
+    # True if every row written so far can be read back after a crash, i.e. no parquet chunk is open.
+    @property
+    def durable(self):
+        return self.file_format != PARQUET or self.file is None
+
+    # Close the current chunk; the next write starts a new one.
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.file_name = None
+
+
+# Incremental sink for backfill pages: tweets, users and tweet keywords of every page are appended to rotating
+# missing_tweets_N / missing_users_N / missing_tweet_keywords_N chunk files, so memory stays flat and a crash loses
+# at most the current page, or with parquet the current chunk. durable tells whether the pages written so far are
+# safe to checkpoint.
+class ChunkSink:
+    def __init__(self, file_format=CSV, directory=".", max_rows=100000, max_bytes=256 << 20,
+                 tweet_prefix="missing_tweets", user_prefix="missing_users", keyword_prefix="missing_tweet_keywords"):
+        self.tweet_writer = ChunkWriter(tweet_prefix, TWEET_COLUMNS, file_format, directory, max_rows, max_bytes)
+        self.user_writer = ChunkWriter(user_prefix, USER_COLUMNS, file_format, directory, max_rows, max_bytes)
+        self.keyword_writer = ChunkWriter(keyword_prefix, KEYWORD_COLUMNS, file_format, directory, max_rows,
+                                          max_bytes)
+
+    def write(self, batch: TweetBatch):
+        self.tweet_writer.write(batch.tweet_columns)
+        self.user_writer.write(batch.user_columns)
+        self.keyword_writer.write(batch.keyword_columns)
+
+    @property
+    def durable(self):
+        return self.tweet_writer.durable and self.user_writer.durable and self.keyword_writer.durable
+
+    @property
+    def tweets_written(self):
+        return self.tweet_writer.total_rows
+
+    @property
+    def users_written(self):
+        return self.user_writer.total_rows
+
+    def close(self):
+        self.tweet_writer.close()
+        self.user_writer.close()
+        self.keyword_writer.close()
+        print(f"Tweets written: {self.tweet_writer.total_rows} to {len(self.tweet_writer.files)} files, "
+              f"Users written: {self.user_writer.total_rows} to {len(self.user_writer.files)} files")
@@ -1,71 +1,260 @@
+import threading
+import time
+from contextlib import contextmanager
+
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, InterfaceError, OperationalError, PoolError
+from mysql.connector.pooling import MySQLConnectionPool
+
+import Metrics
+
+EXECUTE_SECONDS = Metrics.registry.histogram('db_execute_seconds', "Time to execute a query or batch of queries")
+COMMIT_SECONDS = Metrics.registry.histogram('db_commit_seconds', "Time to commit a transaction")
+DB_ERRORS = Metrics.registry.counter('db_errors_total', "Queries that failed")
+DB_RECONNECTS = Metrics.registry.counter('db_reconnects_total', "Queries retried on a new connection")
+
+# Results of a write besides True: REJECTED when the DB refused the query or its data, so retrying it won't help, and
+# UNREACHABLE when the DB could not be reached. Both are falsy.
+REJECTED = None
+UNREACHABLE = False
 
 
 # Class for handling basic MySQL queries.
+# The handler either keeps a single connection (create_connection / create_db_connection) or a pool of connections
+# (create_db_pool). In both modes a dropped connection is re-established and the query is retried, so the handler
+# keeps working after a MySQL restart. The pooled mode lets several threads, e.g. the ingest path and keyword
+# reads, run queries at the same time; the single connection mode serializes them.
 class DBHandler:
-    def __init__(self):
+    def __init__(self, retries=3, retry_delay=1.0):
         self.connection = None
+        self.pool = None
+        self.pool_size = None
+        self.pool_name = None
+        self.connection_args = None
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.lock = threading.RLock()
 
     # Create a connection to the mysql instance
     def create_connection(self, host_name, user_name, user_password):
-        self.connection = None
+        self.connection_args = {
+            'host': host_name,
+            'user': user_name,
+            'passwd': user_password
+        }
+        self.__connect()
+
+    # Create a connection to the MySQL instance and to the database. options are passed on to mysql.connector, e.g.
+    # allow_local_infile=True for LOAD DATA LOCAL INFILE.
+    def create_db_connection(self, host_name, user_name, user_password, db_name, **options):
+        self.connection_args = {
+            'host': host_name,
+            'user': user_name,
+            'passwd': user_password,
+            'database': db_name,
+            **options
+        }
+        self.__connect()
+
+    # Create a pool of connections to the MySQL instance and to the database. Every query borrows a connection from
+    # the pool and returns it when done.
+    def create_db_pool(self, host_name, user_name, user_password, db_name, pool_size=5, pool_name="tweet_pool",
+                       **options):
+        self.connection_args = {
+            'host': host_name,
+            'user': user_name,
+            'passwd': user_password,
+            'database': db_name,
+            **options
+        }
+        self.pool_size = pool_size
+        self.pool_name = pool_name
+        self.__create_pool()
+
+    def __create_pool(self):
+        self.pool = None
         try:
-            self.connection = mysql.connector.connect(
-                host=host_name,
-                user=user_name,
-                passwd=user_password
-            )
-            print("Connection to MySQL DB successful")
+            self.pool = MySQLConnectionPool(pool_name=self.pool_name, pool_size=self.pool_size,
+                                            pool_reset_session=True, **self.connection_args)
+            print(f"Connection pool to MySQL DB created with {self.pool_size} connections")
         except Error as e:
             print(f"The error '{e}' occurred")
 
-    # Create a connection to the MySQL instance and to the database
-    def create_db_connection(self, host_name, user_name, user_password, db_name):
+    def __connect(self):
         self.connection = None
         try:
-            self.connection = mysql.connector.connect(
-                host=host_name,
-                user=user_name,
-                passwd=user_password,
-                database=db_name
-            )
+            self.connection = mysql.connector.connect(**self.connection_args)
             print("Connection to MySQL DB successful")
         except Error as e:
             print(f"The error '{e}' occurred")
 
-    def execute_read_query(self, query):
-        cursor = self.connection.cursor()
+    # Borrow a healthy connection. Pooled connections are pinged (and reconnected if needed) before use, the single
+    # connection is re-created if it was never established or has been dropped by a failed query.
+    @contextmanager
+    def get_connection(self):
+        if self.pool_size is not None:
+            with self.lock:
+                # The pool could not be created if MySQL was down at startup.
+                if self.pool is None:
+                    self.__create_pool()
+                if self.pool is None:
+                    raise InterfaceError("Could not connect to MySQL DB")
+            connection = self.__get_pooled_connection()
+            try:
+                connection.ping(reconnect=True, attempts=1, delay=0)
+                yield connection
+            finally:
+                # Returns the connection to the pool
+                try:
+                    connection.close()
+                except Error:
+                    pass
+        else:
+            with self.lock:
+                if self.connection is None:
+                    if self.connection_args is None:
+                        raise InterfaceError("No connection to MySQL DB has been created")
+                    self.__connect()
+                if self.connection is None:
+                    raise InterfaceError("Could not connect to MySQL DB")
+                yield self.connection
+
+    def __get_pooled_connection(self):
+        # Wait for a free connection if every connection of the pool is in use.
+        delay = 0.01
+        while True:
+            try:
+                return self.pool.get_connection()
+            except PoolError:
+                time.sleep(delay)
+                delay = min(delay * 2, self.retry_delay)
+
+    # Returns True if the DB can be reached.
+    def is_healthy(self):
         try:
-            cursor.execute(query)
-            result = cursor.fetchall()
-            return result
+            with self.get_connection() as connection:
+                connection.ping(reconnect=False)
+            return True
+        except Error:
+            if self.pool_size is None:
+                self.connection = None
+            return False
+
+    # Run operation(cursor) on a connection, committing afterwards if requested. The operation is retried on a
+    # fresh connection when the connection has been dropped, and returns on_error if the DB can't be reached. Any
+    # other error is printed and returns on_rejected.
+    def __run(self, operation, commit=False, on_error=None, on_rejected=None):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.get_connection() as connection:
+                    cursor = connection.cursor()
+                    try:
+                        start = time.perf_counter()
+                        result = operation(cursor)
+                        executed = time.perf_counter()
+                        EXECUTE_SECONDS.observe(executed - start)
+                        if commit:
+                            connection.commit()
+                            COMMIT_SECONDS.observe(time.perf_counter() - executed)
+                        return result
+                    except (InterfaceError, OperationalError):
+                        raise
+                    except Error as e:
+                        DB_ERRORS.inc()
+                        print(f"The error '{e}' occurred")
+                        if commit:
+                            connection.rollback()
+                        return on_rejected
+                    finally:
+                        cursor.close()
+            except (InterfaceError, OperationalError) as e:
+                print(f"The error '{e}' occurred")
+                if self.pool_size is None:
+                    self.connection = None
+                if attempt < self.retries:
+                    DB_RECONNECTS.inc()
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        DB_ERRORS.inc()
+        return on_error
+
+    def execute_read_query(self, query, data=None):
+        def read(cursor):
+            cursor.execute(query, data)
+            return cursor.fetchall()
+
+        return self.__run(read)
+
+    # Run a read query on an unbuffered cursor and yield its rows in lists of up to chunk_size rows, so that the
+    # result is streamed from the server instead of being loaded into memory at once. The connection is held until
+    # the generator is exhausted or closed, so don't run other queries from the same thread while iterating; in the
+    # single connection mode other threads wait for it as well. Errors are printed and end the iteration.
+    def iter_read_query(self, query, data=None, chunk_size=10000):
+        for _, rows in self.__read_chunks(query, data, chunk_size):
+            yield rows
+
+    # Same as iter_read_query, but every chunk is a pandas DataFrame with the column names of the result.
+    def read_frames(self, query, data=None, chunk_size=10000):
+        import pandas as pd
+        for columns, rows in self.__read_chunks(query, data, chunk_size):
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
+    def __read_chunks(self, query, data, chunk_size):
+        try:
+            with self.get_connection() as connection:
+                cursor = connection.cursor(buffered=False)
+                try:
+                    start = time.perf_counter()
+                    cursor.execute(query, data)
+                    EXECUTE_SECONDS.observe(time.perf_counter() - start)
+                    columns = list(cursor.column_names)
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield columns, rows
+                finally:
+                    # The rest of an abandoned result has to be read before the connection can be used again.
+                    try:
+                        connection.consume_results()
+                    except Error:
+                        pass
+                    cursor.close()
         except Error as e:
+            DB_ERRORS.inc()
             print(f"The error '{e}' occurred")
+            if isinstance(e, (InterfaceError, OperationalError)) and self.pool_size is None:
+                self.connection = None
 
     def create_database(self, query):
-        cursor = self.connection.cursor()
-        try:
+        def create(cursor):
             cursor.execute(query)
             print("Database created successfully")
-        except Error as e:
-            print(f"The error '{e}' occurred")
+
+        self.__run(create)
 
     def execute_query(self, query):
-        cursor = self.connection.cursor()
-        try:
-            cursor.execute(query)
-            self.connection.commit()
-            # print("Query executed successfully")
-        except Error as e:
-            print(f"The error '{e}' occurred")
+        self.__run(lambda cursor: cursor.execute(query), commit=True)
 
-    # Execute a query where the data is provided separately.
+    # Execute a query where the data is provided separately. Returns True if it was committed, else REJECTED or
+    # UNREACHABLE.
     def execute_query_with_data(self, query, data):
-        cursor = self.connection.cursor()
-        try:
+        def execute(cursor):
             cursor.execute(query, data)
-            self.connection.commit()
-            # print("Query executed successfully")
-        except Error as e:
-            print(f"The error '{e}' occurred")
+            return True
+
+        return self.__run(execute, commit=True, on_error=UNREACHABLE, on_rejected=REJECTED)
+
+    # Execute a query once for every row in data and commit all rows in a single transaction.
+    # Returns True if the whole batch was committed, else REJECTED or UNREACHABLE.
+    def execute_many_with_data(self, query, data):
+        def execute_many(cursor):
+            cursor.executemany(query, data)
+            return True
+
+        return self.__run(execute_many, commit=True, on_error=UNREACHABLE, on_rejected=REJECTED)
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,263 @@
+import datetime
+import json
+import random
+import time
+
+
+# Local stand-in for TwitterAPI, so the stream, backfill and benchmarks can run without credentials. It serves
+# synthetic or recorded payloads for tweets/search/stream, tweets/search/all (and recent) with pagination,
+# stream rules and tweet lookups, and can enforce a request quota with the x-rate-limit-* headers.
+
+
+# Build a synthetic tweets/search/all response page with expanded users and places.
+def make_page(tweet_count=500, user_count=300, place_count=200, geo_ratio=0.3, seed=0, first_id=1235000000000000000,
+              next_token='token'):
+    rng = random.Random(seed)
+    places = [{'id': f'p{i}', 'full_name': f'Place {i}', 'country': 'United States', 'place_type': 'city',
+               'name': f'Place {i}', 'country_code': 'US'} for i in range(place_count)]
+    users = [{'id': str(1000 + i), 'username': f'user{i}', 'name': f'User {i}', 'location': 'Somewhere',
+              'description': 'A description ' * 5, 'verified': False,
+              'profile_image_url': f'https://example.com/{i}.jpg',
+              'public_metrics': {'followers_count': rng.randint(0, 10000), 'following_count': rng.randint(0, 1000),
+                                 'tweet_count': rng.randint(0, 50000), 'listed_count': 0}}
+             for i in range(user_count)]
+    tweets = []
+    for i in range(tweet_count):
+        created_at = datetime.datetime(2020, 3, 5) + datetime.timedelta(seconds=rng.randint(0, 14 * 86400))
+        tweet = {'id': str(first_id + i), 'author_id': users[rng.randrange(user_count)]['id'],
+                 'created_at': created_at.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                 'text': 'Some tweet text about vaping and juul ' * 3}
+        if rng.random() < 0.3:
+            tweet['referenced_tweets'] = [{'type': 'retweeted', 'id': str(rng.randint(1, 10 ** 18))}]
+        if places and rng.random() < geo_ratio:
+            tweet['geo'] = {'place_id': places[rng.randrange(place_count)]['id']}
+        tweets.append(tweet)
+    meta = {'result_count': tweet_count}
+    if next_token:
+        meta['next_token'] = next_token
+    return {'data': tweets, 'includes': {'users': users, 'places': places}, 'meta': meta}
+
+
+# Split pages into filtered stream items: one tweet per item with its author, its place and the rule it matched.
+def make_stream_items(count=10000, page_size=500, seed=0, rules=('"vape"', '"juul"')):
+    items = []
+    page_index = 0
+    while len(items) < count:
+        page = make_page(min(page_size, count - len(items)), seed=seed + page_index,
+                         first_id=1235000000000000000 + len(items))
+        users_by_id = {user['id']: user for user in page['includes']['users']}
+        places_by_id = {place['id']: place for place in page['includes']['places']}
+        for tweet in page['data']:
+            includes = {'users': [users_by_id[tweet['author_id']]]}
+            if 'geo' in tweet:
+                includes['places'] = [places_by_id[tweet['geo']['place_id']]]
+            rule = len(items) % len(rules)
+            items.append({'data': tweet, 'includes': includes,
+                          'matching_rules': [{'id': str(rule + 1), 'tag': rules[rule]}]})
+        page_index += 1
+    return items
+
+
+# Synthetic search/all pages chained by next_token, the same page_count pages for every query.
+def make_search_pages(page_count=10, page_size=500, seed=0):
+    pages = {}
+    for i in range(page_count):
+        next_token = f'page-{i + 1}' if i + 1 < page_count else None
+        pages[f'page-{i}' if i else ''] = make_page(page_size, seed=seed + i,
+                                                    first_id=1235000000000000000 + i * page_size,
+                                                    next_token=next_token)
+    return pages
+
+
+# The parts of TwitterResponse the project uses: status_code, headers, text, json(), iterating stream items and
+# iter_lines() for the raw stream lines. Stream items are yielded at most rate per second; None yields them as fast
+# as they are read. The raw lines have an empty heartbeat line after every heartbeat_every items.
+class FakeResponse:
+    def __init__(self, status_code=200, json_data=None, items=None, headers=None, rate=None, lines=None,
+                 heartbeat_every=None):
+        self.status_code = status_code
+        self.json_data = json_data
+        self.items = items if items is not None else []
+        self.headers = headers if headers is not None else {}
+        self.rate = rate
+        self.lines = lines
+        self.heartbeat_every = heartbeat_every
+
+    @property
+    def text(self):
+        return json.dumps(self.json_data)
+
+    def json(self):
+        return self.json_data
+
+    def get_iterator(self):
+        return iter(self)
+
+    def __iter__(self):
+        return self.__paced(self.items)
+
+    def iter_lines(self, chunk_size=None):
+        lines = self.lines if self.lines is not None else [json.dumps(item).encode("utf-8") for item in self.items]
+        for i, line in enumerate(self.__paced(lines)):
+            yield line
+            if self.heartbeat_every and i % self.heartbeat_every == self.heartbeat_every - 1:
+                yield b''
+
+    def __paced(self, items):
+        start = time.monotonic()
+        for i, item in enumerate(items):
+            if self.rate:
+                wait = start + i / self.rate - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            yield item
+
+
+class FakeTwitterAPI:
+    # stream_items: items of every tweets/search/stream connection. The connection ends once they are all read.
+    # search_pages: search/all responses by next_token ('' for the first page), either for every query or keyed by
+    # (query, next_token). rate: stream items per second. rate_limit: requests allowed per window seconds for the
+    # search and lookup endpoints, None for no limit. heartbeat_every: items between keep-alive lines in the raw
+    # stream.
+    def __init__(self, stream_items=None, search_pages=None, rate=None, rate_limit=None, window=900.0,
+                 heartbeat_every=100):
+        self.stream_items = stream_items if stream_items is not None else make_stream_items(1000)
+        self.search_pages = search_pages if search_pages is not None else make_search_pages()
+        self.rate = rate
+        self.rate_limit = rate_limit
+        self.heartbeat_every = heartbeat_every
+        # Encoded once, the raw lines stand for the bytes read from the network.
+        self.stream_lines = [json.dumps(item).encode("utf-8") for item in self.stream_items]
+        self.window = window
+        self.window_start = time.time()
+        self.window_requests = 0
+        self.rules = {}
+        self.next_rule_id = 1
+        self.requests = []
+
+    # Replay the responses recorded by RecordingTwitterAPI.
+    @staticmethod
+    def from_recording(file_name, rate=None, rate_limit=None):
+        stream_items = []
+        search_pages = {}
+        with open(file_name, "r") as file:
+            for line in file:
+                record = json.loads(line)
+                resource = record['resource']
+                if resource == 'tweets/search/stream':
+                    stream_items.extend(record['items'])
+                elif resource.startswith('tweets/search/') and resource != 'tweets/search/stream/rules':
+                    params = record['params'] or {}
+                    search_pages[(params.get('query', ''), params.get('next_token', ''))] = record['json']
+        return FakeTwitterAPI(stream_items, search_pages, rate, rate_limit)
+
+    def request(self, resource, params=None, files=None, method_override=None, hydrate_type=None):
+        self.requests.append((resource, params))
+        if resource == 'tweets/search/stream':
+            return FakeResponse(200, items=self.stream_items, rate=self.rate, lines=self.stream_lines,
+                                heartbeat_every=self.heartbeat_every)
+        if resource == 'tweets/search/stream/rules':
+            return self.__rules(params, method_override)
+        headers = self.__quota()
+        if headers.get('x-rate-limit-remaining') == '-1':
+            headers['x-rate-limit-remaining'] = '0'
+            return FakeResponse(429, {'title': 'Too Many Requests', 'status': 429}, headers=headers)
+        if resource in ('tweets/search/all', 'tweets/search/recent'):
+            params = params or {}
+            token = params.get('next_token', '')
+            page = self.search_pages.get((params.get('query', ''), token), self.search_pages.get(token))
+            if page is None:
+                return FakeResponse(400, {'title': 'Invalid Request', 'detail': f'Unknown next_token {token}'},
+                                    headers=headers)
+            return FakeResponse(200, page, headers=headers)
+        if resource.startswith('tweets/:'):
+            tweet_id = resource[len('tweets/:'):]
+            for item in self.stream_items:
+                if item['data']['id'] == tweet_id:
+                    return FakeResponse(200, {'data': item['data'], 'includes': item['includes']}, headers=headers)
+            return FakeResponse(200, {'errors': [{'title': 'Not Found Error', 'value': tweet_id}]}, headers=headers)
+        return FakeResponse(404, {'title': 'Not Found', 'detail': resource})
+
+    # Count the request against the quota and return the rate limit headers. A remaining of -1 means the request is
+    # over the quota.
+    def __quota(self):
+        if self.rate_limit is None:
+            return {}
+        now = time.time()
+        if now - self.window_start >= self.window:
+            self.window_start = now
+            self.window_requests = 0
+        self.window_requests += 1
+        return {'x-rate-limit-limit': str(self.rate_limit),
+                'x-rate-limit-remaining': str(max(-1, self.rate_limit - self.window_requests)),
+                'x-rate-limit-reset': str(int(self.window_start + self.window))}
+
+    def __rules(self, params, method_override):
+        if method_override == 'GET' or not params:
+            if not self.rules:
+                return FakeResponse(200, {'meta': {'result_count': 0}})
+            return FakeResponse(200, {'data': [{'id': rule_id, 'value': value} for rule_id, value in
+                                               self.rules.items()], 'meta': {'result_count': len(self.rules)}})
+        created = []
+        for rule in params.get('add', []):
+            rule_id = str(self.next_rule_id)
+            self.next_rule_id += 1
+            self.rules[rule_id] = rule['value']
+            created.append({'id': rule_id, 'value': rule['value']})
+        deleted = 0
+        for rule_id in params.get('delete', {}).get('ids', []):
+            if self.rules.pop(rule_id, None) is not None:
+                deleted += 1
+        return FakeResponse(201 if created else 200, {'data': created, 'meta': {'summary': {
+            'created': len(created), 'deleted': deleted}}})
+
+
+# Wraps a real TwitterAPI and appends every response to a JSON lines file for FakeTwitterAPI.from_recording.
+# Stream items are recorded as they are read, every max_items items per line.
+class RecordingTwitterAPI:
+    def __init__(self, api, file_name="twitter_recording.jsonl", max_items=1000):
+        self.api = api
+        self.file_name = file_name
+        self.max_items = max_items
+
+    def request(self, resource, params=None, files=None, method_override=None, **kwargs):
+        r = self.api.request(resource, params, files, method_override, **kwargs)
+        if resource == 'tweets/search/stream':
+            return RecordingStream(r, self, resource, params)
+        try:
+            self.record(resource, params, r.status_code, r.json())
+        except ValueError:
+            pass
+        return r
+
+    def record(self, resource, params, status_code, json_data=None, items=None):
+        record = {'resource': resource, 'params': params, 'status_code': status_code}
+        if items is not None:
+            record['items'] = items
+        else:
+            record['json'] = json_data
+        with open(self.file_name, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+
+class RecordingStream:
+    def __init__(self, response, recorder: RecordingTwitterAPI, resource, params):
+        self.response = response
+        self.recorder = recorder
+        self.resource = resource
+        self.params = params
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    def __iter__(self):
+        items = []
+        try:
+            for item in self.response:
+                items.append(item)
+                if len(items) >= self.recorder.max_items:
+                    self.recorder.record(self.resource, self.params, self.status_code, items=items)
+                    items = []
+                yield item
+        finally:
+            if items:
+                self.recorder.record(self.resource, self.params, self.status_code, items=items)
@@ -1,14 +1,17 @@
-from typing import List
-
-from TwitterAPI import TwitterAPI, TwitterOAuth, TwitterRequestError, TwitterConnectionError, HydrateType
 import stream_utils
 from TwitterStream import TwitterStream
-from math import ceil
-import pandas as pd
 import os.path
-from TwitterAPIWrapper import TwitterJSONWrapper, TwitterUser, Tweet
-import traceback
-import time
+from TwitterAPIWrapper import TweetBatch
+from ProfileCache import ProfileCache
+from TweetDeduplicator import TweetDeduplicator
+from BackfillExecutor import BackfillExecutor, QueryCursor, split_time_range
+from RateLimiter import RateLimiter
+from ChunkSink import ChunkSink, next_file_index
+from CheckpointStore import CheckpointStore
+from BackfillProcessPool import BackfillProcessPool, chunk_sink
+from KeywordMatcher import KeywordMatcher
+import QueryPacker
+import threading
 import json
 
 
@@ -22,11 +25,25 @@ class OldTweetGetter(TwitterStream):
     USER_FIELDS = 'location,profile_image_url,verified,public_metrics,description'
     PLACE_FIELDS = 'contained_within,country,country_code,full_name,geo,id,name,place_type'
     tweet_data_file_name = "old_tweet_data.csv"
-    users: List[TwitterUser]
-    tweets: List[Tweet]
+    batch: TweetBatch
 
-    def __init__(self, keywords):
-        super().__init__()
+    def __init__(self, keywords, profile_cache: ProfileCache = None, deduplicator: TweetDeduplicator = None,
+                 sink=None, checkpoint_store: CheckpointStore = None, api=None, keyword_ids=None):
+        super().__init__(api=api)
+        # With the (keyword, id) pairs of the keywords, every tweet is tagged with the ids of the keywords found in
+        # its text, since search results don't say which keyword of a query they matched.
+        if keyword_ids is not None:
+            self.keyword_ids = dict(keyword_ids)
+            self.keyword_matcher = KeywordMatcher(self.keyword_ids)
+        # Progress of every work unit is saved here and resumed from by get_old_tweets.
+        self.checkpoint_store = checkpoint_store
+        # When a sink is given every page is written to it instead of being kept in memory: a ChunkSink appends it
+        # to chunk files, a BulkLoader loads it into MySQL.
+        self.sink = sink
+        # Users whose profile is unchanged since it was last collected are left out of the users files.
+        self.profile_cache = profile_cache
+        # Tweets returned by more than one (overlapping) query are only stored once.
+        self.deduplicator = deduplicator
         self.metadata_fields = {
             'expansions': OldTweetGetter.EXPANSIONS,
             'tweet.fields': OldTweetGetter.TWEET_FIELDS,
@@ -38,108 +55,188 @@ class OldTweetGetter(TwitterStream):
             # 'next_token': '',
             'max_results': 500
         }
-        self.users = []
-        self.tweets = []
+        # Pages are parsed straight into this batch until it is dumped to file.
+        self.batch = TweetBatch()
+        self.store_lock = threading.RLock()
+        # Full-archive search quota, shared by every query.
+        self.search_rate_limiter = RateLimiter(max_requests=300, window=900.0, min_interval=1.0,
+                                                  name='search')
         self.queries = self.set_queries(keywords)
         self.last_query_checkpoint = ['' for i in range(len(self.queries))]
+        # Cursors of the (query, time window) work units of the current backfill.
+        self.cursors = []
+        # Progress of the cursors whose pages the sink hasn't made durable yet, by CheckpointStore key.
+        self.pending_checkpoints = {}
         print("Number of Query Strings: " + str(len(self.queries)))
-        if os.path.isfile(self.tweet_data_file_name):
-            self.df = pd.read_csv(self.tweet_data_file_name)
-        else:
-            self.df = pd.DataFrame()
-            self.df.to_csv(index=False)
+        self.__df = None
+        # The BackfillProcessPool of the last get_old_tweets, if it used one.
+        self.process_pool = None
+
+    # Tweets collected before, read from tweet_data_file_name on first use so that startup doesn't pay for pandas
+    # and the whole file. The file is memory mapped instead of being copied through a read buffer.
+    @property
+    def df(self):
+        if self.__df is None:
+            import pandas as pd
+            if os.path.isfile(self.tweet_data_file_name):
+                self.__df = pd.read_csv(self.tweet_data_file_name, memory_map=True)
+            else:
+                self.__df = pd.DataFrame()
+        return self.__df
 
+    # Thread safe, pages fetched by the BackfillExecutor are stored from several threads. Raises if the sink could
+    # not write the page, so that the executor fetches it again instead of checkpointing past it.
     def store_tweet(self, data):
-        self.users.extend(data.users)
-        self.tweets.extend(data.tweets)
+        with self.store_lock:
+            if self.deduplicator is not None:
+                self.deduplicator.filter(data, remember=False)
+            self.tag_keywords(data)
+            user_start = data.user_start
+            if data.batch is not self.batch:
+                user_start = self.batch.user_count
+                self.batch.extend(data.batch)
+            user_rows = []
+            if self.profile_cache is not None:
+                self.profile_cache.filter_batch(self.batch, user_start)
+                user_rows = self.batch.user_rows(user_start)
 
-        if len(self.tweets) > 100000:
-            self.dump_to_file()
-            self.users = []
-            self.tweets = []
+            if self.sink is not None:
+                tweet_ids = list(self.batch.tweet_columns[0])
+                written = self.sink.write(self.batch)
+                self.batch.clear()
+                if written is False:
+                    raise IOError("The sink could not write the page")
+                if self.deduplicator is not None:
+                    self.deduplicator.remember(tweet_ids)
+                if self.profile_cache is not None:
+                    self.profile_cache.store(user_rows)
+                return
+            if self.deduplicator is not None:
+                self.deduplicator.remember(data.batch.tweet_columns[0][data.tweet_start:data.tweet_end])
+            if self.profile_cache is not None:
+                self.profile_cache.store(user_rows)
+            if len(self.batch) > 100000:
+                self.dump_to_file()
+                self.batch.clear()
 
+    # Nothing is left to write after a run of the BackfillProcessPool, whose workers close their own sinks.
     def dump_to_file(self):
+        if self.process_pool is not None:
+            return
+        if self.sink is not None:
+            self.sink.close()
+            if self.checkpoint_store is not None:
+                self.save_durable_checkpoints()
+            return
+        self.write_batch_to_file()
+        if self.checkpoint_store is not None:
+            self.checkpoint_store.save(self.cursors)
+
+    def write_batch_to_file(self):
         print("Dumping to CSV files")
-        user_df = pd.DataFrame([user.user_dict() for user in self.users])
-        tweet_df = pd.DataFrame([tweet.tweet_dict() for tweet in self.tweets])
-        user_file_count = tweet_file_count = 0
-
-        while os.path.isfile(f"missing_users_{user_file_count}.csv"):
-            user_file_count += 1
-        while os.path.isfile(f"missing_tweets_{tweet_file_count}.csv"):
-            tweet_file_count += 1
+        user_df = self.batch.user_frame()
+        tweet_df = self.batch.tweet_frame()
+        user_file_count = next_file_index("missing_users", "csv")
+        tweet_file_count = next_file_index("missing_tweets", "csv")
         print(f"missing_tweets_{tweet_file_count}.csv", f"missing_users_{user_file_count}.csv")
         user_df.to_csv(f"missing_users_{user_file_count}.csv", index=False)
         tweet_df.to_csv(f"missing_tweets_{tweet_file_count}.csv", index=False)
+        if self.batch.keyword_count:
+            keyword_file_count = next_file_index("missing_tweet_keywords", "csv")
+            self.batch.keyword_frame().to_csv(f"missing_tweet_keywords_{keyword_file_count}.csv", index=False)
 
-    def get_old_tweets(self, start_time, end_time, checkpoints_file_name=None):
+    # Every query, or every (query, time window) pair when a window ('day', 'hour' or a timedelta) is given, is a
+    # QueryCursor paginated by a BackfillExecutor; with workers > 1 several cursors are fetched at the same time.
+    # Progress is resumed from the checkpoint store, or from a list of next_tokens in checkpoints_file_name.
+    # endpoint is 'tweets/search/all' or 'tweets/search/recent' (last 7 days). store, if given, is called with every
+    # page instead of store_tweet.
+    # With processes > 0 the pages are parsed and written by a BackfillProcessPool of that many worker processes, each
+    # with its own sink made by sink_factory (chunk files by default, see BackfillProcessPool.db_sink for MySQL),
+    # instead of by store_tweet and the sink; the threads here only fetch.
+    def get_old_tweets(self, start_time, end_time, checkpoints_file_name=None, workers=1, window=None,
+                       endpoint='tweets/search/all', store=None, processes=0, sink_factory=None):
         self.metadata_fields['start_time'] = start_time
         self.metadata_fields['end_time'] = end_time
-        query_completed = [False for i in range(len(self.queries))]
+        # Recent search returns at most 100 tweets per page.
+        self.metadata_fields['max_results'] = 100 if endpoint == 'tweets/search/recent' else 500
+        windows = split_time_range(start_time, end_time, window) if window is not None else [(start_time, end_time)]
+        self.cursors = [QueryCursor(query, '', window_start, window_end)
+                        for window_start, window_end in windows for query in self.queries]
+        print(f"Number of work units: {len(self.cursors)}")
 
         # To resume
         if checkpoints_file_name:
             print("Using old checkpoints")
             self.read_checkpoints_from_file(checkpoints_file_name)
+            if window is None:
+                for cursor, next_token in zip(self.cursors, self.last_query_checkpoint):
+                    cursor.next_token = next_token
+        if self.checkpoint_store is not None:
+            resumed = sum(self.checkpoint_store.restore(cursor) for cursor in self.cursors)
+            if resumed:
+                print(f"Resuming {resumed} work units from {self.checkpoint_store.file_name}")
+
+        pool = None
+        if processes:
+            pool = BackfillProcessPool(sink_factory if sink_factory is not None else chunk_sink, processes,
+                                       self.keyword_ids, self.save_pool_checkpoint,
+                                       deduplicate=self.deduplicator is not None,
+                                       cache_profiles=self.profile_cache is not None)
+        executor = BackfillExecutor(self.api, self.metadata_fields, store if store is not None else self.store_tweet,
+                                    workers, self.search_rate_limiter, endpoint, checkpoint=self.save_checkpoint,
+                                    pool=pool)
+        try:
+            executor.run(self.cursors)
+        finally:
+            if pool is not None:
+                pool.close()
+        self.process_pool = pool
+        if window is None:
+            self.last_query_checkpoint = [cursor.next_token for cursor in self.cursors]
+        if store is None:
+            self.print_summary()
 
-        end_flag = False
-        while True:
-            for i in range(len(self.queries)):
-                if not query_completed[i]:
-                    try:
-                        if len(self.last_query_checkpoint[i]) != 0:
-                            self.metadata_fields['next_token'] = self.last_query_checkpoint[i]
-                        elif 'next_token' in self.metadata_fields:
-                            self.metadata_fields.pop('next_token')
-                        self.metadata_fields['query'] = self.queries[i]
-
-                        r = self.api.request('tweets/search/all', self.metadata_fields,
-                                             hydrate_type=HydrateType.NONE)
-                        response_json = r.json()
-                        data = TwitterJSONWrapper(response_json)
-
-                        if data.next_token:
-                            self.last_query_checkpoint[i] = data.next_token
-                        else:
-                            query_completed[i] = True
-
-                        if data.result_count == 0:
-                            query_completed[i] = True
-                        print(data.result_count)
-                        self.store_tweet(data)
-
-                        print(r.get_quota())
-                        time.sleep(2.5)
-                        # if r.get_quota()['remaining'] < 5:
-                        #     # sleep
-                        #     print("Rate limit reached. Sleeping for 15 min")
-
-                    except TwitterRequestError as e:
-                        print(e.status_code)
-                        for msg in iter(e):
-                            print(msg)
-
-                    except TwitterConnectionError as e:
-                        print(e)
-
-                    except KeyboardInterrupt:
-                        print("Keyboard interrupt. Stopping now")
-                        end_flag = True
-                        break
-
-                    except Exception as e:
-                        print(e)
-                        traceback.print_exc()
-            # Break if all queries have completed
-            if sum(query_completed) == len(query_completed) or end_flag:
-                break
-        print("Number of Tweets collected: " + str(len(self.tweets)))
-        print("Number of Users collected: " + str(len(self.users)))
-
-    def store_checkpoints(self):
-        with open('checkpoints.json', "w") as file:
-            json.dump(self.last_query_checkpoint, file, indent=1)
+    # Pages written by the sink are checkpointed once the sink reports them as durable: right away for csv chunks
+    # and the BulkLoader, once the chunk has been closed for parquet. Until then the cursor's progress after the page
+    # is kept in pending_checkpoints. Without a sink the pages are only kept in memory and all cursors are
+    # checkpointed once they have been dumped to file.
+    def save_checkpoint(self, cursor):
+        if self.checkpoint_store is None or self.sink is None:
+            return
+        snapshot = QueryCursor(cursor.query, cursor.next_token, cursor.start_time, cursor.end_time)
+        snapshot.completed = cursor.completed
+        with self.store_lock:
+            self.pending_checkpoints[CheckpointStore.key(cursor)] = snapshot
+            self.save_durable_checkpoints()
 
+    def save_durable_checkpoints(self):
+        with self.store_lock:
+            if not self.pending_checkpoints or not getattr(self.sink, 'durable', True):
+                return
+            self.checkpoint_store.save(list(self.pending_checkpoints.values()))
+            self.pending_checkpoints = {}
+
+    # The pool checkpoints a cursor once its pages up to this one have been written by the worker processes.
+    def save_pool_checkpoint(self, cursor):
+        if self.checkpoint_store is not None:
+            self.checkpoint_store.save([cursor])
+
+    def print_summary(self):
+        if self.process_pool is not None:
+            tweet_count, user_count = self.process_pool.tweets_written, self.process_pool.users_written
+        elif self.sink is not None:
+            tweet_count, user_count = self.sink.tweets_written, self.sink.users_written
+        else:
+            tweet_count, user_count = self.batch.tweet_count, self.batch.user_count
+        print("Number of Tweets collected: " + str(tweet_count))
+        print("Number of Users collected: " + str(user_count))
+        print(self.search_rate_limiter.stats())
+        if self.profile_cache is not None:
+            print(self.profile_cache.stats())
+        if self.deduplicator is not None:
+            print(f"Duplicate tweets dropped: {self.deduplicator.duplicates}")
+
+    # Old checkpoint files hold the next_token of every query.
     def read_checkpoints_from_file(self, file_name):
         with open(file_name, "r") as file:
             self.last_query_checkpoint = json.load(file)
@@ -148,34 +245,19 @@ class OldTweetGetter(TwitterStream):
     def set_queries(keywords):
         # query string can have only 1024 characters. The string has to be composed of the words joined by the OR
         # clause. Ex: "'nicotine' OR 'juul' OR 'vape' OR..."
-        twitter_query_character_limit = 1024
-        total_keyword_character_length = sum((len(keyword) + 4) for keyword in keywords)
-        number_of_queries_required = ceil(total_keyword_character_length / twitter_query_character_limit)
-        avg_query_length = ceil(total_keyword_character_length / number_of_queries_required)
-
-        # TODO Sort Strings in alphabetical order for better performance?
-        query = ""
-        rule_strings = [query]
-        for keyword in keywords:
-            if len(query) > avg_query_length:
-                query = f"\"{keyword}\" OR "
-                rule_strings.append(query)
-            else:
-                query += f"\"{keyword}\" OR "
-                rule_strings[-1] = query
-        # Remove last OR
-        for i in range(len(rule_strings)):
-            query = rule_strings[i]
-            rule_strings[i] = query[:-4]
-            print(rule_strings[i])
-
+        # Every query string is paginated separately, so the keywords are packed into as few strings as possible.
+        rule_strings = QueryPacker.pack_keywords(keywords, QueryPacker.SEARCH_QUERY_LIMIT)
+        for query in rule_strings:
+            print(query)
+        print(QueryPacker.packing_report(keywords, rule_strings, QueryPacker.SEARCH_QUERY_LIMIT))
         return rule_strings
 
 
 def main():
     missing_keywords = stream_utils.read_keywords('missing_keywords.txt')
-    streamer = OldTweetGetter(missing_keywords)
-    streamer.get_old_tweets('2020-03-05T06:43:25Z', '2020-03-19T08:14:22Z')
+    streamer = OldTweetGetter(missing_keywords, ProfileCache(), TweetDeduplicator(), ChunkSink(),
+                              CheckpointStore("checkpoints.json"))
+    streamer.get_old_tweets('2020-03-05T06:43:25Z', '2020-03-19T08:14:22Z', workers=4, window='day')
     streamer.dump_to_file()
 
 
@@ -0,0 +1,86 @@
+from collections import deque
+
+
+def normalize(text):
+    return " ".join(text.casefold().split())
+
+
+def is_word_character(character):
+    return character.isalnum() or character == '_'
+
+
+# Finds which of a list of keywords occur in a text with an Aho-Corasick automaton, built once from the keywords, so
+# a text is scanned once whatever the number of keywords. Like Twitter's phrase matching, keywords are matched
+# case-insensitively, as whole words and with any run of whitespace standing for a space; "covid" matches
+# "#COVID" and "covid-19" but not "covidiot".
+# keyword_ids maps every keyword to its id in the twitter_keywords table, either as a dict or as (keyword, id) pairs.
+class KeywordMatcher:
+    def __init__(self, keyword_ids):
+        if isinstance(keyword_ids, dict):
+            keyword_ids = keyword_ids.items()
+        # State 0 is the root; goto holds the transitions of every state, fail the state to fall back to and
+        # outputs the (length, id, check start, check end) of the keywords that end in the state.
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        self.keyword_count = 0
+        for keyword, keyword_id in keyword_ids:
+            pattern = normalize(keyword)
+            if not pattern:
+                continue
+            state = 0
+            for character in pattern:
+                next_state = self.goto[state].get(character)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                    self.goto[state][character] = next_state
+                state = next_state
+            # Word boundaries are only checked where the keyword starts or ends with a word character.
+            self.outputs[state].append((len(pattern), keyword_id, is_word_character(pattern[0]),
+                                        is_word_character(pattern[-1])))
+            self.keyword_count += 1
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and character not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(character, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    # Ids of the keywords that occur in text.
+    def match(self, text):
+        found = set()
+        if not text or self.keyword_count == 0:
+            return found
+        text = normalize(text)
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        length = len(text)
+        state = 0
+        for end, character in enumerate(text):
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            for keyword_length, keyword_id, check_start, check_end in outputs[state]:
+                start = end - keyword_length + 1
+                if check_start and start > 0 and is_word_character(text[start - 1]):
+                    continue
+                if check_end and end + 1 < length and is_word_character(text[end + 1]):
+                    continue
+                found.add(keyword_id)
+        return found
+
+    # Add a (tweet id, keyword id) row to batch for every keyword found in the text of its tweets from start to end.
+    def tag_batch(self, batch, start=0, end=None):
+        tweet_ids = batch.tweet_columns[0]
+        texts = batch.tweet_columns[2]
+        for i in range(start, len(tweet_ids) if end is None else end):
+            for keyword_id in sorted(self.match(texts[i])):
+                batch.append_keyword(tweet_ids[i], keyword_id)
@@ -0,0 +1,44 @@
+import threading
+import traceback
+
+
+# Polls the keywords every interval seconds and calls on_change with the new list whenever the set of keywords
+# differs from the last one seen. load returns the keywords, or None if they could not be read.
+class KeywordWatcher:
+    def __init__(self, load, on_change, interval=60.0):
+        self.load = load
+        self.on_change = on_change
+        self.interval = interval
+        self.keywords = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.keywords = self.__load()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.__poll, name="KeywordWatcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __load(self):
+        keywords = self.load()
+        return None if keywords is None else set(keywords)
+
+    def __poll(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                keywords = self.__load()
+                if keywords is not None and keywords != self.keywords:
+                    added = len(keywords - self.keywords) if self.keywords is not None else len(keywords)
+                    removed = len(self.keywords - keywords) if self.keywords is not None else 0
+                    print(f"Keywords changed: {added} added, {removed} removed")
+                    self.keywords = keywords
+                    self.on_change(sorted(keywords))
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
@@ -0,0 +1,253 @@
+import json
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, labels=()):
+        self.name = name
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+    def summary(self):
+        return self.value
+
+
+# Value read from a function when the metrics are collected, e.g. the depth of a queue.
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, labels=(), function=None):
+        self.name = name
+        self.labels = labels
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float('nan')
+        return self.value
+
+    def samples(self):
+        return [(self.name, self.labels, self.get())]
+
+    def summary(self):
+        return self.get()
+
+
+# Latency histogram with fixed buckets. Observations only take a lock and a short scan, so it can be used on the
+# per-item paths.
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    # Time the body of a with statement.
+    def time(self):
+        return Timer(self)
+
+    # Estimate of quantile q: the upper bound of the bucket that holds it.
+    def quantile(self, q):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append((self.name + "_bucket", self.labels + (('le', repr(bound)),), cumulative))
+        samples.append((self.name + "_bucket", self.labels + (('le', '+Inf'),), count))
+        samples.append((self.name + "_sum", self.labels, total))
+        samples.append((self.name + "_count", self.labels, count))
+        return samples
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+# All metrics of the process by name and labels. Asking for a metric that already exists returns it, so modules
+# can look up their metrics once at import time and instances can register labelled ones.
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.help = {}
+
+    def __get(self, metric_class, name, description, labels, **kwargs):
+        labels = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            metric = self.metrics.get((name, labels))
+            if metric is None:
+                metric = metric_class(name, labels, **kwargs)
+                self.metrics[(name, labels)] = metric
+                self.help[name] = (description, metric_class.kind)
+            return metric
+
+    def counter(self, name, description="", labels=None):
+        return self.__get(Counter, name, description, labels)
+
+    def histogram(self, name, description="", labels=None, buckets=LATENCY_BUCKETS):
+        return self.__get(Histogram, name, description, labels, buckets=buckets)
+
+    # A gauge registered again with the same name and labels reads from the new function.
+    def gauge(self, name, description="", labels=None, function=None):
+        gauge = self.__get(Gauge, name, description, labels)
+        gauge.function = function
+        return gauge
+
+    # Prometheus text exposition format.
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+            help_texts = dict(self.help)
+        lines = []
+        last_name = None
+        for (name, _), metric in metrics:
+            if name != last_name:
+                description, kind = help_texts[name]
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                last_name = name
+            for sample_name, labels, value in metric.samples():
+                lines.append(f"{sample_name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    # One flat dict of every metric, histograms as count, mean, p50 and p99.
+    def snapshot(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return {name + format_labels(labels): metric.summary() for (name, labels), metric in metrics}
+
+
+# The registry the project's modules report to.
+registry = Registry()
+
+
+# Serves the registry at http://host:port/metrics for Prometheus to scrape.
+class MetricsServer:
+    def __init__(self, port=9108, host="127.0.0.1", metrics: Registry = None):
+        # Only imported when metrics are served, it is one of the slower imports at startup.
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = metrics if metrics is not None else registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print(f"Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Prints a snapshot of the registry as one JSON log line every interval seconds.
+class MetricsLogger:
+    def __init__(self, interval=60.0, metrics: Registry = None):
+        self.interval = interval
+        self.metrics = metrics if metrics is not None else registry
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__log_loop, name="MetricsLogger", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.log()
+
+    def log(self):
+        print("metrics " + json.dumps(self.metrics.snapshot(), default=str))
+
+    def __log_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.log()
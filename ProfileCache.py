@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+from TwitterAPIWrapper import TweetBatch
+
+
+# Bounded LRU cache of a fingerprint of the last stored version of each user profile, keyed by user id.
+# Every tweet carries its author's profile, and REPLACE INTO twitter_profiles is a delete plus an insert in MySQL,
+# so profiles that have not changed since they were last stored are skipped.
+class ProfileCache:
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.fingerprints = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(row):
+        return hash(row)
+
+    # row is a user row in USER_COLUMNS order, the same as TwitterUser.user_tuple().
+    def is_unchanged(self, row):
+        fingerprint = ProfileCache.fingerprint(row)
+        with self.lock:
+            if self.fingerprints.get(row[0]) == fingerprint:
+                self.fingerprints.move_to_end(row[0])
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    # Remember rows as stored.
+    def store(self, rows):
+        with self.lock:
+            for row in rows:
+                self.fingerprints[row[0]] = ProfileCache.fingerprint(row)
+                self.fingerprints.move_to_end(row[0])
+            while len(self.fingerprints) > self.max_size:
+                self.fingerprints.popitem(last=False)
+
+    # Returns the rows whose profile is not in the cache yet. If a user appears more than once, the last row wins,
+    # as it would with consecutive REPLACE statements.
+    def changed_rows(self, rows):
+        latest = {}
+        for row in rows:
+            latest[row[0]] = row
+        return [row for row in latest.values() if not self.is_unchanged(row)]
+
+    # Drop the unchanged users from batch, starting at user row start. The caller stores the remaining ones once the
+    # sink has written them, so a page whose write failed is not filtered away on its retry.
+    def filter_batch(self, batch: TweetBatch, start=0):
+        rows = self.changed_rows(batch.user_rows(start))
+        for column in batch.user_columns:
+            del column[start:]
+        for row in rows:
+            batch.append_user(*row)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return f"Profile cache: {len(self.fingerprints)} profiles, {self.hits} hits, {self.misses} misses, " \
+               f"hit rate {self.hit_rate:.1%}"
@@ -0,0 +1,61 @@
+import re
+from math import ceil
+
+# Maximum length of a tweets/search/all query and of a filtered stream rule.
+SEARCH_QUERY_LIMIT = 1024
+STREAM_RULE_LIMIT = 512
+SEPARATOR = " OR "
+# A quoted keyword
+QUOTED = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+
+# Keywords are matched as exact phrases, so they are quoted and any quote inside them is escaped.
+def quote(keyword):
+    escaped = keyword.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+# The keywords of a rule or query made by quote or pack_keywords.
+def unquote_keywords(query):
+    return [re.sub(r'\\(.)', r'\1', keyword) for keyword in QUOTED.findall(query)]
+
+
+# Pack keywords into as few "kw1" OR "kw2" OR ... strings as possible, none longer than limit.
+# A query of quoted keywords q1..qn is sum(len(qi)) + 4 * (n - 1) characters long, so every keyword takes
+# len(qi) + 4 of a bin of limit + 4 characters, which makes this exact bin packing. Keywords are packed
+# first-fit-decreasing, which never uses more than 11/9 of the optimal number of strings (plus one).
+def pack_keywords(keywords, limit=SEARCH_QUERY_LIMIT):
+    capacity = limit + len(SEPARATOR)
+    items = sorted({quote(keyword) for keyword in keywords if keyword}, key=lambda item: (-len(item), item))
+    bins = []
+    free = []
+    for item in items:
+        size = len(item) + len(SEPARATOR)
+        if size > capacity:
+            raise ValueError(f"Keyword is longer than the {limit} character limit: {item}")
+        for i in range(len(bins)):
+            if free[i] >= size:
+                bins[i].append(item)
+                free[i] -= size
+                break
+        else:
+            bins.append([item])
+            free.append(capacity - size)
+    return [SEPARATOR.join(items) for items in bins]
+
+
+# Lower bound on the number of strings any packing needs: the total size divided by the bin size, or the number of
+# keywords that can't share a string with each other, whichever is larger.
+def lower_bound(keywords, limit=SEARCH_QUERY_LIMIT):
+    capacity = limit + len(SEPARATOR)
+    sizes = [len(quote(keyword)) + len(SEPARATOR) for keyword in set(keywords) if keyword]
+    if not sizes:
+        return 0
+    return max(ceil(sum(sizes) / capacity), sum(1 for size in sizes if size > capacity / 2))
+
+
+def packing_report(keywords, queries, limit=SEARCH_QUERY_LIMIT):
+    bound = lower_bound(keywords, limit)
+    fill = sum(len(query) for query in queries) / (len(queries) * limit) if queries else 0.0
+    return f"{len(queries)} query strings for {len(set(keywords))} keywords, lower bound {bound}, " \
+           f"average fill {fill:.1%} of {limit} characters"
@@ -0,0 +1,132 @@
+import random
+import threading
+import time
+from collections import deque
+
+import Metrics
+
+
+# Paces requests to one Twitter API endpoint. Until the first response arrives it allows at most max_requests per
+# window seconds. After that it follows the x-rate-limit-remaining / x-rate-limit-reset headers of every response
+# and spreads the remaining requests evenly until the reset, so the whole window is used without hitting 429s.
+# After a 429 it waits for the reset; after other errors it backs off exponentially with jitter.
+# Shared by every thread that calls the endpoint. name labels the limiter's metrics.
+class RateLimiter:
+    def __init__(self, max_requests=300, window=900.0, min_interval=1.0, base_backoff=5.0, max_backoff=900.0,
+                 jitter=0.25, name='default'):
+        self.max_requests = max_requests
+        self.window = window
+        self.min_interval = min_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        # Values from the last response headers. reset is on the time.monotonic() clock.
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.request_times = deque()
+        self.last_request = None
+        self.backoff_until = 0.0
+        self.consecutive_failures = 0
+        # Metrics
+        self.started = time.monotonic()
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.wait_time = 0.0
+        labels = {'limiter': name}
+        self.wait_histogram = Metrics.registry.histogram('rate_limit_wait_seconds', "Time a request waited for the "
+                                                         "rate limiter", labels)
+        self.throttled_counter = Metrics.registry.counter('rate_limit_throttled_total', "429 responses", labels)
+        Metrics.registry.gauge('rate_limit_remaining', "Requests left in the current rate limit window", labels,
+                               lambda: self.remaining if self.remaining is not None else float('nan'))
+        Metrics.registry.gauge('rate_limit_utilization', "Share of the allowed requests that have been used", labels,
+                               lambda: self.utilization)
+
+    # Block until a request may be sent.
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.__wait_time(now)
+                if wait <= 0:
+                    self.__record_request(now)
+                    self.wait_histogram.observe(waited)
+                    return
+                self.wait_time += wait
+            time.sleep(wait)
+            waited += wait
+
+    def __wait_time(self, now):
+        wait = self.backoff_until - now
+        if self.last_request is not None:
+            wait = max(wait, self.last_request + self.min_interval - now)
+        if self.reset is not None and now < self.reset:
+            if self.remaining <= 0:
+                wait = max(wait, self.reset - now)
+            else:
+                # Spread the remaining requests evenly over what is left of the window.
+                pace = (self.reset - now) / self.remaining
+                if self.last_request is not None:
+                    wait = max(wait, self.last_request + pace - now)
+        else:
+            while self.request_times and now - self.request_times[0] >= self.window:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.max_requests:
+                wait = max(wait, self.request_times[0] + self.window - now)
+        return wait
+
+    def __record_request(self, now):
+        self.last_request = now
+        self.request_times.append(now)
+        self.requests += 1
+        if self.reset is not None and now < self.reset:
+            # Count requests that are still in flight until their response updates the quota.
+            self.remaining -= 1
+
+    # Read the quota from the response headers.
+    def update(self, response):
+        headers = getattr(response, 'headers', None) or {}
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        limit = headers.get('x-rate-limit-limit')
+        with self.lock:
+            if remaining is not None and reset is not None:
+                self.remaining = int(remaining)
+                self.reset = time.monotonic() + max(0.0, int(reset) - time.time())
+            if limit is not None:
+                self.limit = int(limit)
+            if getattr(response, 'status_code', 200) == 200:
+                self.consecutive_failures = 0
+
+    # Back off after a failed request. A 429 waits for the quota reset when it is known.
+    def backoff(self, status_code=None):
+        with self.lock:
+            now = time.monotonic()
+            if status_code == 429:
+                self.throttled += 1
+                self.throttled_counter.inc()
+            else:
+                self.errors += 1
+            if status_code == 429 and self.reset is not None and now < self.reset:
+                self.remaining = 0
+                until = self.reset
+            else:
+                delay = min(self.max_backoff, self.base_backoff * 2 ** self.consecutive_failures)
+                until = now + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self.consecutive_failures += 1
+            self.backoff_until = max(self.backoff_until, until)
+
+    # Share of the requests allowed since the limiter was created that have been used.
+    @property
+    def utilization(self):
+        elapsed = time.monotonic() - self.started
+        limit = self.limit if self.limit is not None else self.max_requests
+        allowed = limit * max(elapsed, self.min_interval) / self.window
+        return min(1.0, self.requests / allowed) if allowed else 0.0
+
+    def stats(self):
+        return f"Requests: {self.requests}, rate limit waits: {self.wait_time:.1f}s, 429s: {self.throttled}, " \
+               f"errors: {self.errors}, remaining: {self.remaining}, utilization: {self.utilization:.0%}"
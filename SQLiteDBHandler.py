@@ -0,0 +1,170 @@
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import Metrics
+
+# Same metrics as DBHandler's
+EXECUTE_SECONDS = Metrics.registry.histogram('db_execute_seconds', "Time to execute a query or batch of queries")
+COMMIT_SECONDS = Metrics.registry.histogram('db_commit_seconds', "Time to commit a transaction")
+DB_ERRORS = Metrics.registry.counter('db_errors_total', "Queries that failed")
+
+
+# SQLite stand-in for DBHandler with the same query methods, for running the ingest path and benchmarks without a
+# MySQL server. The project's queries name their tables {database}.table, so every database is ATTACHed under its
+# MySQL name, in memory by default. The MySQL query syntax the project uses is translated: %s placeholders to ?,
+# INSERT IGNORE to INSERT OR IGNORE and CREATE DATABASE to ATTACH.
+class SQLiteDBHandler:
+    # Schema of the tables the project reads and writes, in MySQL types that SQLite accepts.
+    TABLES = {
+        'tweets': "CREATE TABLE IF NOT EXISTS {db}.tweets (id VARCHAR(32) PRIMARY KEY, createdAt DATETIME, "
+                  "text TEXT, userId VARCHAR(32), isRetweet TINYINT, latitude DOUBLE, longitude DOUBLE, "
+                  "place_country VARCHAR(255), place_name VARCHAR(255), place_type VARCHAR(64))",
+        'twitter_profiles': "CREATE TABLE IF NOT EXISTS {db}.twitter_profiles (userId VARCHAR(32) PRIMARY KEY, "
+                            "description TEXT, friendsCount INT, followersCount INT, screenName VARCHAR(64), "
+                            "statusesCount INT, location VARCHAR(255), name VARCHAR(255))",
+        'twitter_keywords': "CREATE TABLE IF NOT EXISTS {db}.twitter_keywords (id INTEGER PRIMARY KEY, "
+                            "keyword VARCHAR(255) UNIQUE)",
+        'tweet_keywords': "CREATE TABLE IF NOT EXISTS {db}.tweet_keywords (tweetId VARCHAR(32), keywordId INT, "
+                          "PRIMARY KEY (tweetId, keywordId))",
+    }
+    INDEXES = [
+        "CREATE INDEX IF NOT EXISTS {db}.idx_tweets_createdAt ON tweets (createdAt)",
+        "CREATE INDEX IF NOT EXISTS {db}.idx_tweets_userId_createdAt ON tweets (userId, createdAt)",
+        "CREATE INDEX IF NOT EXISTS {db}.idx_tweet_keywords_keywordId ON tweet_keywords (keywordId, tweetId)",
+    ]
+
+    # file_name is the main database, databases are stored in {directory}/{name}.db unless directory is None, in
+    # which case they are kept in memory.
+    def __init__(self, file_name=":memory:", directory=None):
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.databases = set()
+
+    # Attach database name and create its tables and indexes.
+    def create_tables(self, name):
+        self.attach(name)
+        with self.lock:
+            for query in list(SQLiteDBHandler.TABLES.values()) + SQLiteDBHandler.INDEXES:
+                self.connection.execute(query.format(db=name))
+            self.connection.commit()
+
+    def attach(self, name):
+        with self.lock:
+            if name in self.databases:
+                return
+            path = ":memory:" if self.directory is None else f"{self.directory}/{name}.db"
+            self.connection.execute("ATTACH DATABASE ? AS " + name, (path,))
+            self.databases.add(name)
+
+    @staticmethod
+    def translate(query):
+        query = query.replace("%s", "?")
+        return re.sub(r"^\s*INSERT\s+IGNORE\b", "INSERT OR IGNORE", query, flags=re.IGNORECASE)
+
+    @contextmanager
+    def get_connection(self):
+        with self.lock:
+            yield self.connection
+
+    def is_healthy(self):
+        try:
+            with self.get_connection() as connection:
+                connection.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    # Run operation(cursor), committing afterwards if requested. Errors are printed and return on_error.
+    def __run(self, operation, commit=False, on_error=None):
+        with self.get_connection() as connection:
+            cursor = connection.cursor()
+            try:
+                start = time.perf_counter()
+                result = operation(cursor)
+                executed = time.perf_counter()
+                EXECUTE_SECONDS.observe(executed - start)
+                if commit:
+                    connection.commit()
+                    COMMIT_SECONDS.observe(time.perf_counter() - executed)
+                return result
+            except sqlite3.Error as e:
+                DB_ERRORS.inc()
+                print(f"The error '{e}' occurred")
+                if commit:
+                    connection.rollback()
+                return on_error
+            finally:
+                cursor.close()
+
+    def execute_read_query(self, query, data=None):
+        def read(cursor):
+            cursor.execute(SQLiteDBHandler.translate(query), data or ())
+            return cursor.fetchall()
+
+        return self.__run(read)
+
+    # Yields the rows of a read query in lists of up to chunk_size rows, like DBHandler.iter_read_query.
+    def iter_read_query(self, query, data=None, chunk_size=10000):
+        for _, rows in self.__read_chunks(query, data, chunk_size):
+            yield rows
+
+    def read_frames(self, query, data=None, chunk_size=10000):
+        import pandas as pd
+        for columns, rows in self.__read_chunks(query, data, chunk_size):
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
+    def __read_chunks(self, query, data, chunk_size):
+        try:
+            with self.get_connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    start = time.perf_counter()
+                    cursor.execute(SQLiteDBHandler.translate(query), data or ())
+                    EXECUTE_SECONDS.observe(time.perf_counter() - start)
+                    columns = [column[0] for column in cursor.description]
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield columns, rows
+                finally:
+                    cursor.close()
+        except sqlite3.Error as e:
+            DB_ERRORS.inc()
+            print(f"The error '{e}' occurred")
+
+    def create_database(self, query):
+        match = re.match(r"\s*CREATE\s+DATABASE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?(\w+)`?", query, re.IGNORECASE)
+        if match is None:
+            print(f"The error 'Unsupported query: {query}' occurred")
+            return
+        self.attach(match.group(1))
+        print("Database created successfully")
+
+    def execute_query(self, query):
+        self.__run(lambda cursor: cursor.execute(SQLiteDBHandler.translate(query)), commit=True)
+
+    # Returns True if the query was committed. There is no connection to lose, so an error is always
+    # DBHandler.REJECTED (None).
+    def execute_query_with_data(self, query, data):
+        def execute(cursor):
+            cursor.execute(SQLiteDBHandler.translate(query), data)
+            return True
+
+        return self.__run(execute, commit=True)
+
+    # Returns True if the whole batch was committed, else DBHandler.REJECTED (None).
+    def execute_many_with_data(self, query, data):
+        def execute_many(cursor):
+            cursor.executemany(SQLiteDBHandler.translate(query), data)
+            return True
+
+        return self.__run(execute_many, commit=True)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
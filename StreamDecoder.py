@@ -0,0 +1,164 @@
+import json
+import time
+from typing import List, Optional
+
+from TwitterAPIWrapper import TwitterJSONWrapper, TweetBatch, PARSE_SECONDS, TWEETS_PARSED
+
+# Optional fast JSON decoders. msgspec decodes straight into the typed schemas below, orjson into dicts.
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if msgspec is not None:
+    # Only the fields that are stored are declared; msgspec skips every other field (profile_image_url, verified,
+    # entities, ...) without building Python objects for them.
+    class PublicMetrics(msgspec.Struct):
+        following_count: int = 0
+        followers_count: int = 0
+        tweet_count: int = 0
+
+    class User(msgspec.Struct):
+        id: str = ''
+        username: str = ''
+        name: str = ''
+        location: str = ''
+        description: str = ''
+        public_metrics: Optional[PublicMetrics] = None
+
+    class Place(msgspec.Struct):
+        id: str = ''
+        full_name: str = ''
+        country: str = ''
+        place_type: str = ''
+
+    class ReferencedTweet(msgspec.Struct):
+        type: str = ''
+
+    class Geo(msgspec.Struct):
+        place_id: str = ''
+
+    class TweetData(msgspec.Struct):
+        id: str = ''
+        author_id: str = ''
+        created_at: str = ''
+        text: str = ''
+        referenced_tweets: List[ReferencedTweet] = []
+        geo: Optional[Geo] = None
+
+    class Includes(msgspec.Struct):
+        users: List[User] = []
+        places: List[Place] = []
+
+    class MatchingRule(msgspec.Struct):
+        id: str = ''
+
+    class StreamItem(msgspec.Struct):
+        data: Optional[TweetData] = None
+        includes: Optional[Includes] = None
+        errors: Optional[list] = None
+        matching_rules: List[MatchingRule] = []
+
+
+# Decodes the raw lines of a filtered stream response straight into TweetBatch rows. Heartbeats (empty keep-alive
+# lines) are skipped without decoding. With msgspec the lines are decoded into the schemas above, so only the stored
+# fields are materialized; otherwise they are decoded with orjson, or json, and parsed by TwitterJSONWrapper.
+class StreamDecoder:
+    def __init__(self):
+        if msgspec is not None:
+            self.decoder = msgspec.json.Decoder(StreamItem)
+            self.mode = 'msgspec'
+        elif orjson is not None:
+            self.decoder = orjson.loads
+            self.mode = 'orjson'
+        else:
+            self.decoder = json.loads
+            self.mode = 'json'
+        self.heartbeats = 0
+        self.errors = 0
+
+    # The raw lines of a stream response: TwitterAPI keeps the requests response in r.response, a FakeResponse
+    # yields them itself. chunk_size=None hands every chunk over as soon as it arrives.
+    @staticmethod
+    def lines(r):
+        if hasattr(r, 'iter_lines'):
+            return r.iter_lines()
+        return r.response.iter_lines(chunk_size=None)
+
+    @staticmethod
+    def is_heartbeat(line):
+        return len(line) <= 2 and not line.strip()
+
+    # The raw lines of r without the heartbeats.
+    def items(self, r):
+        for line in StreamDecoder.lines(r):
+            if len(line) <= 2 and not line.strip():
+                self.heartbeats += 1
+                continue
+            yield line
+
+    # Returns a TwitterJSONWrapper over the decoded rows, or None for heartbeats, messages without a tweet and
+    # lines that can't be decoded. Items that were already decoded to dicts, e.g. read back from a spill file, are
+    # parsed as before.
+    def decode(self, line):
+        if isinstance(line, dict):
+            return TwitterJSONWrapper(line)
+        if StreamDecoder.is_heartbeat(line):
+            self.heartbeats += 1
+            return None
+        if self.mode != 'msgspec':
+            try:
+                response = self.decoder(line)
+            except ValueError as e:
+                self.__error(f"Could not decode stream item: {e}")
+                return None
+            if 'data' not in response:
+                self.__error(response.get('errors', response))
+                return None
+            return TwitterJSONWrapper(response)
+        start = time.perf_counter()
+        try:
+            item = self.decoder.decode(line)
+        except ValueError as e:
+            self.__error(f"Could not decode stream item: {e}")
+            return None
+        tweet = item.data
+        if tweet is None:
+            self.__error(item.errors)
+            return None
+        batch = TweetBatch()
+        includes = item.includes
+        is_retweet = 0
+        for referenced_tweet in tweet.referenced_tweets:
+            if referenced_tweet.type == 'retweeted':
+                is_retweet = 1
+                break
+        place_country = place_name = place_type = None
+        if tweet.geo is not None and includes is not None:
+            for place in includes.places:
+                if place.id == tweet.geo.place_id:
+                    place_name = place.full_name
+                    place_country = place.country
+                    place_type = place.place_type
+                    break
+        batch.append_tweet(tweet.id, TwitterJSONWrapper.process_date(tweet.created_at), tweet.text, tweet.author_id,
+                           is_retweet, None, None, place_country, place_name, place_type)
+        if includes is not None:
+            for user in includes.users:
+                if user.id == tweet.author_id:
+                    public_metrics = user.public_metrics if user.public_metrics is not None else PublicMetrics()
+                    batch.append_user(user.id, user.description, public_metrics.following_count,
+                                      public_metrics.followers_count, user.username, public_metrics.tweet_count,
+                                      user.location, user.name)
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+        TWEETS_PARSED.inc()
+        return TwitterJSONWrapper.from_batch(batch, [rule.id for rule in item.matching_rules])
+
+    def __error(self, errors):
+        self.errors += 1
+        print(errors)
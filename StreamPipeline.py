@@ -0,0 +1,225 @@
+import json
+import os
+import queue
+import threading
+import traceback
+
+from TwitterAPIWrapper import TwitterJSONWrapper
+import Metrics
+
+RECEIVED = Metrics.registry.counter('stream_items_received_total', "Items read from the stream")
+STORE_SECONDS = Metrics.registry.histogram('stream_store_seconds', "Time to store one parsed stream item")
+
+# Policies for a full queue between two pipeline stages.
+BLOCK = 'block'  # wait until the next stage has room (backpressure)
+DROP = 'drop'  # drop the item and count it
+SPILL = 'spill'  # append the item to a file on disk; it is read back once the queue has drained
+
+
+# Append-only JSON lines file that holds the items which did not fit in a queue.
+class SpillFile:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.read_offset = 0
+        self.pending = 0
+        self.skipped = 0
+        # Items left over from a previous run are read back first.
+        if os.path.isfile(file_name):
+            with open(file_name, "r") as file:
+                lines = file.readlines()
+            self.pending = len(lines)
+            # The last record was cut short by a crash. End its line so that the next item isn't appended to it.
+            if lines and not lines[-1].endswith("\n"):
+                with open(file_name, "a") as file:
+                    file.write("\n")
+
+    # Raw stream lines are JSON already and are read back as dicts.
+    def write(self, item):
+        line = (item.decode("utf-8") if isinstance(item, bytes) else json.dumps(item)) + "\n"
+        with self.lock:
+            with open(self.file_name, "a") as file:
+                file.write(line)
+            self.pending += 1
+
+    # Returns the oldest spilled item or None if the file has been drained. Lines that aren't valid JSON, e.g. a
+    # record cut short by a crash, are skipped.
+    def read(self):
+        with self.lock:
+            while self.pending:
+                try:
+                    with open(self.file_name, "r") as file:
+                        file.seek(self.read_offset)
+                        line = file.readline()
+                        self.read_offset = file.tell()
+                except OSError as e:
+                    print(f"Could not read {self.pending} spilled items: {e}")
+                    self.skipped += self.pending
+                    self.pending = 0
+                    self.read_offset = 0
+                    return None
+                self.pending -= 1
+                if self.pending == 0:
+                    os.remove(self.file_name)
+                    self.read_offset = 0
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    print(f"Skipping a spilled item that is not valid JSON: {line[:100]!r}")
+                    self.skipped += 1
+            return None
+
+
+# Bounded queue between two pipeline stages with a policy for when it is full.
+class StageQueue:
+    def __init__(self, maxsize, policy=BLOCK, spill_file_name=None):
+        if policy == SPILL and spill_file_name is None:
+            raise ValueError("The spill policy needs a spill file name")
+        self.queue = queue.Queue(maxsize)
+        self.policy = policy
+        self.spill = SpillFile(spill_file_name) if policy == SPILL else None
+        self.dropped = 0
+        self.spilled = 0
+
+    def put(self, item):
+        if self.policy == BLOCK:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.policy == SPILL:
+                self.spill.write(item)
+                self.spilled += 1
+            else:
+                self.dropped += 1
+
+    # Returns the next item, falling back to spilled items once the queue is empty. Raises queue.Empty on timeout.
+    def get(self, timeout):
+        if self.spill is not None:
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                item = self.spill.read()
+                if item is not None:
+                    return item
+        return self.queue.get(timeout=timeout)
+
+    def depth(self):
+        depth = self.queue.qsize()
+        if self.spill is not None:
+            depth += self.spill.pending
+        return depth
+
+
+# Producer/consumer pipeline for the stream. The reader (the thread that calls feed) only puts raw items in a
+# bounded queue, parse workers turn them into TwitterJSONWrapper objects, and write workers hand those to store.
+# The reader therefore never waits on MySQL: with the default policies a slow DB fills the parsed queue, which
+# blocks the parse workers, and the raw queue then spills to disk instead of blocking the reader.
+# verbose prints a count every 10 received items. parse turns an item into a TwitterJSONWrapper, or None to skip it,
+# e.g. StreamDecoder.decode for raw stream lines.
+class StreamPipeline:
+    def __init__(self, store, parse_workers=1, write_workers=1, raw_queue_size=10000, parsed_queue_size=1000,
+                 raw_policy=SPILL, parsed_policy=BLOCK, spill_file_name="stream_spill.jsonl", verbose=True,
+                 parse=TwitterJSONWrapper):
+        if parsed_policy == SPILL:
+            raise ValueError("Parsed items can't be spilled, use the spill policy for the raw queue")
+        self.store = store
+        self.parse = parse
+        self.raw_queue = StageQueue(raw_queue_size, raw_policy, spill_file_name)
+        self.parsed_queue = StageQueue(parsed_queue_size, parsed_policy)
+        self.parse_worker_count = parse_workers
+        self.write_worker_count = write_workers
+        self.parse_threads = []
+        self.write_threads = []
+        self.stopping = threading.Event()
+        self.count_lock = threading.Lock()
+        self.received = 0
+        self.parsed = 0
+        self.written = 0
+        self.errors = 0
+        self.verbose = verbose
+        for name, stage_queue in (('raw', self.raw_queue), ('parsed', self.parsed_queue)):
+            labels = {'queue': name}
+            Metrics.registry.gauge('pipeline_queue_depth', "Items waiting in a pipeline queue, including spilled "
+                                   "items", labels, stage_queue.depth)
+            Metrics.registry.gauge('pipeline_dropped_items', "Items dropped because a pipeline queue was full",
+                                   labels, lambda stage_queue=stage_queue: stage_queue.dropped)
+            Metrics.registry.gauge('pipeline_spilled_items', "Items spilled to disk because a pipeline queue was "
+                                   "full", labels, lambda stage_queue=stage_queue: stage_queue.spilled)
+
+    def start(self):
+        self.stopping.clear()
+        self.parse_threads = [threading.Thread(target=self.__parse_loop, name=f"StreamParse-{i}", daemon=True)
+                              for i in range(self.parse_worker_count)]
+        self.write_threads = [threading.Thread(target=self.__write_loop, name=f"StreamWrite-{i}", daemon=True)
+                              for i in range(self.write_worker_count)]
+        for thread in self.parse_threads + self.write_threads:
+            thread.start()
+
+    # Reader stage. Consumes the stream response until it ends or raises; the exception is left to the caller.
+    def feed(self, items):
+        verbose = self.verbose
+        for item in items:
+            self.raw_queue.put(item)
+            RECEIVED.inc()
+            if verbose and self.received % 10 == 0:
+                print(f"Count: {self.received}")
+            self.received += 1
+
+    # Let the workers finish every queued (and spilled) item, then stop them.
+    def stop(self):
+        self.stopping.set()
+        for thread in self.parse_threads:
+            thread.join()
+        for _ in self.write_threads:
+            self.parsed_queue.queue.put(None)
+        for thread in self.write_threads:
+            thread.join()
+        print(f"Pipeline stopped. Received: {self.received}, Parsed: {self.parsed}, Written: {self.written}, "
+              f"Dropped: {self.raw_queue.dropped + self.parsed_queue.dropped}, Errors: {self.errors}")
+
+    def __parse_loop(self):
+        while True:
+            try:
+                item = self.raw_queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return
+                continue
+            except Exception as e:
+                # Keep the worker alive, otherwise the reader would spill to disk forever.
+                print(e)
+                traceback.print_exc()
+                with self.count_lock:
+                    self.errors += 1
+                continue
+            try:
+                data = self.parse(item)
+                if data is None:
+                    continue
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+                with self.count_lock:
+                    self.errors += 1
+                continue
+            self.parsed_queue.put(data)
+            with self.count_lock:
+                self.parsed += 1
+
+    def __write_loop(self):
+        while True:
+            data = self.parsed_queue.queue.get()
+            if data is None:
+                return
+            try:
+                with STORE_SECONDS.time():
+                    self.store(data)
+                with self.count_lock:
+                    self.written += 1
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+                with self.count_lock:
+                    self.errors += 1
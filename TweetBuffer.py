@@ -0,0 +1,188 @@
+import threading
+import time
+
+from TwitterAPIWrapper import TweetBatch
+from TweetDBHandler import TweetDBHandler
+from DBHandler import DBHandler
+from ProfileCache import ProfileCache
+from WriteJournal import WriteJournal
+import Metrics
+
+FLUSH_SECONDS = Metrics.registry.histogram('buffer_flush_seconds', "Time to write one TweetBuffer batch to the DB")
+ROWS_WRITTEN = Metrics.registry.counter('buffer_rows_written_total', "Tweet and user rows written by TweetBuffer")
+FLUSH_FAILURES = Metrics.registry.counter('buffer_flush_failures_total', "TweetBuffer flushes that were requeued")
+ROWS_REFUSED = Metrics.registry.counter('buffer_rows_refused_total', "Rows the DB refused, dropped by TweetBuffer")
+
+
+# Write-behind buffer that collects tweets, users and their keywords and stores them in the DB in batches instead of
+# one commit per row. A flush is triggered when the number of buffered rows, their approximate size in bytes or the
+# time since the last flush passes its limit. Call close() on shutdown so that buffered rows are not lost.
+# If max_pending_rows is set, add() waits while that many rows are buffered, which gives backpressure to the caller
+# when the DB falls behind. With a profile_cache, profiles that have not changed since they were last stored are
+# skipped.
+# Only rows that could not reach the DB are retried. If the DB rejects a batch, e.g. for a value it can't store, the
+# batch is written again one row at a time and only the rows it still refuses are dropped.
+# With a journal, rows of a failed flush are appended to it instead of being requeued, and once journal_rows rows are
+# buffered the whole buffer is moved to it instead of waiting for the DB. While the journal holds rows, flushes go to
+# the journal as well, so that its replayer writes everything to the DB in the order it was received. While the
+# journal is full, rows stay in the buffer and max_pending_rows holds back the caller.
+class TweetBuffer:
+    # Rough per-row size of the non-text columns, used to estimate the size of the buffer.
+    ROW_OVERHEAD = 64
+    batch: TweetBatch
+
+    def __init__(self, db_handler: DBHandler, max_rows=500, max_bytes=1 << 20, max_interval=5.0, background=True,
+                 max_pending_rows=None, profile_cache: ProfileCache = None, journal: WriteJournal = None,
+                 journal_rows=None):
+        self.db_handler = db_handler
+        self.journal = journal
+        self.journal_rows = journal_rows
+        self.profile_cache = profile_cache
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.max_pending_rows = max_pending_rows
+        self.batch = TweetBatch()
+        self.byte_size = 0
+        self.last_flush = time.monotonic()
+        self.flush_count = 0
+        self.tweets_written = 0
+        self.users_written = 0
+        self.rows_journaled = 0
+        self.rows_refused = 0
+        # lock guards the pending rows, flush_lock makes sure batches are written one at a time and in order.
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.stopped = False
+        self.flush_thread = None
+        Metrics.registry.gauge('buffer_pending_rows', "Rows waiting in the TweetBuffer", function=self.pending)
+        if background:
+            self.flush_thread = threading.Thread(target=self.__flush_loop, name="TweetBufferFlush", daemon=True)
+            self.flush_thread.start()
+
+    # Add the tweets and users of a TwitterJSONWrapper to the buffer.
+    def add(self, data):
+        self.add_batch(data.batch)
+
+    def add_batch(self, batch: TweetBatch):
+        size = TweetBuffer.ROW_OVERHEAD * (batch.tweet_count + batch.user_count) + batch.text_size()
+        queued = False
+        if self.journal_rows is not None and self.journal is not None and not self.journal.is_full():
+            with self.lock:
+                spill = self.__pending() + batch.tweet_count + batch.user_count >= self.journal_rows
+                if spill:
+                    spilled, self.batch = self.batch, TweetBatch()
+                    spilled.extend(batch)
+                    self.byte_size = 0
+            if spill:
+                if self.__journal(spilled):
+                    return
+                # The journal is full and the rows are back in the buffer, so wait for room like any other add.
+                queued = True
+        with self.lock:
+            while self.max_pending_rows is not None and self.__pending() >= self.max_pending_rows:
+                if self.flush_thread is None:
+                    break
+                self.flush_event.set()
+                self.flushed.wait(self.max_interval)
+            if not queued:
+                self.batch.extend(batch)
+                self.byte_size += size
+            due = self.is_due()
+        if due:
+            if self.flush_thread is not None:
+                self.flush_event.set()
+            else:
+                self.flush()
+
+    def is_due(self):
+        return (self.__pending() >= self.max_rows
+                or self.byte_size >= self.max_bytes
+                or time.monotonic() - self.last_flush >= self.max_interval)
+
+    def __pending(self):
+        return self.batch.tweet_count + self.batch.user_count
+
+    def pending(self):
+        with self.lock:
+            return self.__pending()
+
+    # Write all buffered rows to the DB. Rows that could not reach the DB go to the journal, or are put back at the
+    # front of the buffer so that the next flush retries them.
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.batch = self.batch, TweetBatch()
+                self.byte_size = 0
+                self.last_flush = time.monotonic()
+                self.flushed.notify_all()
+            if batch.tweet_count == 0 and batch.user_count == 0 and batch.keyword_count == 0:
+                return True
+            if self.journal is not None and self.journal.depth() > 0:
+                return self.__journal(batch)
+            tweet_count, user_count = batch.tweet_count, batch.user_count
+            with FLUSH_SECONDS.time():
+                refused = TweetDBHandler.write_batch(batch, self.db_handler, self.profile_cache)
+            self.flush_count += 1
+            tweets = tweet_count - batch.tweet_count - refused.tweet_count
+            users = user_count - batch.user_count - refused.user_count
+            self.tweets_written += tweets
+            self.users_written += users
+            ROWS_WRITTEN.inc(tweets + users)
+            refused_rows = refused.tweet_count + refused.user_count + refused.keyword_count
+            if refused_rows:
+                self.rows_refused += refused_rows
+                ROWS_REFUSED.inc(refused_rows)
+                print(f"Dropped {refused_rows} rows the DB refused")
+            if batch.tweet_count or batch.user_count or batch.keyword_count:
+                FLUSH_FAILURES.inc()
+                if self.journal is not None:
+                    return self.__journal(batch)
+                self.__requeue(batch)
+                return False
+            return True
+
+    def __requeue(self, batch: TweetBatch):
+        with self.lock:
+            batch.extend(self.batch)
+            self.batch = batch
+
+    # Append batch to the journal. If the journal is full the rows are put back at the front of the buffer, without
+    # trying again until the journal has room.
+    def __journal(self, batch: TweetBatch):
+        if not self.journal.is_full() and self.journal.append(batch):
+            self.rows_journaled += batch.tweet_count + batch.user_count + batch.keyword_count
+            return True
+        self.__requeue(batch)
+        return False
+
+    # Stop the background flusher and write out everything that is still buffered.
+    def close(self):
+        self.stopped = True
+        if self.flush_thread is not None:
+            self.flush_event.set()
+            self.flush_thread.join()
+            self.flush_thread = None
+        self.flush()
+        print(f"TweetBuffer closed. Tweets written: {self.tweets_written}, Users written: {self.users_written}, "
+              f"Rows refused: {self.rows_refused}")
+        if self.journal is not None:
+            print(f"Rows journaled: {self.rows_journaled}")
+        if self.profile_cache is not None:
+            print(self.profile_cache.stats())
+
+    def __flush_loop(self):
+        while not self.stopped:
+            self.flush_event.wait(self.max_interval)
+            self.flush_event.clear()
+            if self.stopped:
+                break
+            with self.lock:
+                due = self.is_due()
+            if due:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(e)
@@ -1,25 +1,186 @@
-from TwitterAPIWrapper import Tweet, TwitterUser
-from DBHandler import DBHandler
+from TwitterAPIWrapper import Tweet, TwitterUser, TweetBatch
+from DBHandler import DBHandler, REJECTED, UNREACHABLE
+from ProfileCache import ProfileCache
 
 
 # Utility methods that generates SQL queries for Twitter data and stores it in the DB using a DBHandler instance.
 class TweetDBHandler:
     DATABASE_NAME: str = "tcorstwitter"
+    # Schema of the tables the project writes. tweets is indexed on createdAt for time range reads and on
+    # (userId, createdAt) for reading the tweets of a user, which the join with twitter_profiles on userId uses too.
+    TABLES = {
+        'tweets': "CREATE TABLE IF NOT EXISTS {db}.tweets (id VARCHAR(32) NOT NULL, createdAt DATETIME NOT NULL, "
+                  "text TEXT, userId VARCHAR(32) NOT NULL, isRetweet TINYINT, latitude DOUBLE, longitude DOUBLE, "
+                  "place_country VARCHAR(255), place_name VARCHAR(255), place_type VARCHAR(64), PRIMARY KEY (id), "
+                  "KEY idx_tweets_createdAt (createdAt), KEY idx_tweets_userId_createdAt (userId, createdAt)) "
+                  "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4",
+        'twitter_profiles': "CREATE TABLE IF NOT EXISTS {db}.twitter_profiles (userId VARCHAR(32) NOT NULL, "
+                            "description TEXT, friendsCount INT, followersCount INT, screenName VARCHAR(64), "
+                            "statusesCount INT, location VARCHAR(255), name VARCHAR(255), PRIMARY KEY (userId)) "
+                            "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4",
+        'twitter_keywords': "CREATE TABLE IF NOT EXISTS {db}.twitter_keywords (id INT NOT NULL AUTO_INCREMENT, "
+                            "keyword VARCHAR(255) NOT NULL, PRIMARY KEY (id), UNIQUE KEY (keyword)) "
+                            "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4",
+        # The keywords every tweet matched, looked up by tweet through the primary key and by keyword through
+        # idx_tweet_keywords_keywordId.
+        'tweet_keywords': "CREATE TABLE IF NOT EXISTS {db}.tweet_keywords (tweetId VARCHAR(32) NOT NULL, "
+                          "keywordId INT NOT NULL, PRIMARY KEY (tweetId, keywordId), "
+                          "KEY idx_tweet_keywords_keywordId (keywordId, tweetId)) ENGINE=InnoDB",
+    }
+    # Secondary indexes by table and name, for adding them to tables that were created without them.
+    INDEXES = {
+        'tweets': {
+            'idx_tweets_createdAt': "createdAt",
+            'idx_tweets_userId_createdAt': "userId, createdAt",
+        },
+    }
+
+    # Create the tables that don't exist yet and add the indexes that are missing from existing ones.
     @staticmethod
-    def insert_tweet(tweet: Tweet, db_handler: DBHandler):
-        query = (
-            f"INSERT INTO {TweetDBHandler.DATABASE_NAME}.tweets (id, createdAt, text, userId, isRetweet, latitude, longitude, place_country, place_name, place_type) "
+    def create_tables(db_handler: DBHandler):
+        for query in TweetDBHandler.TABLES.values():
+            db_handler.execute_query(query.format(db=TweetDBHandler.DATABASE_NAME))
+        TweetDBHandler.create_indexes(db_handler)
+
+    @staticmethod
+    def create_indexes(db_handler: DBHandler):
+        rows = db_handler.execute_read_query(
+            "SELECT table_name, index_name FROM information_schema.statistics WHERE table_schema = %s",
+            (TweetDBHandler.DATABASE_NAME,))
+        if rows is None:
+            return
+        existing = {(table, index) for table, index in rows}
+        for table, indexes in TweetDBHandler.INDEXES.items():
+            for index, columns in indexes.items():
+                if (table, index) not in existing:
+                    print(f"Adding index {index} to {table}")
+                    db_handler.execute_query(f"ALTER TABLE {TweetDBHandler.DATABASE_NAME}.{table} "
+                                             f"ADD INDEX {index} ({columns})")
+
+    @staticmethod
+    def tweet_query(insert="INSERT"):
+        return (
+            f"{insert} INTO {TweetDBHandler.DATABASE_NAME}.tweets (id, createdAt, text, userId, isRetweet, latitude, longitude, place_country, place_name, place_type) "
             "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
         )
-        # values = TweetDBHandler.gen_tweet_query_values(tweet)
-        values = tweet.tweet_tuple()
-        db_handler.execute_query_with_data(query, values)
 
     @staticmethod
-    def insert_user(user: TwitterUser, db_handler: DBHandler):
-        query = (
+    def user_query():
+        return (
             f"REPLACE INTO {TweetDBHandler.DATABASE_NAME}.twitter_profiles(userId, description, friendsCount, followersCount, screenName, statusesCount, location, name) "
             "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)"
         )
+
+    @staticmethod
+    def keyword_query():
+        return (f"INSERT IGNORE INTO {TweetDBHandler.DATABASE_NAME}.tweet_keywords (tweetId, keywordId) "
+                "VALUES (%s,%s)")
+
+    @staticmethod
+    def insert_tweet(tweet: Tweet, db_handler: DBHandler):
+        query = TweetDBHandler.tweet_query()
+        # values = TweetDBHandler.gen_tweet_query_values(tweet)
+        values = tweet.tweet_tuple()
+        return db_handler.execute_query_with_data(query, values)
+
+    # Profiles that are unchanged according to profile_cache are not written again. The cache is only updated once
+    # the profile has been committed. Returns True if the profile was committed or skipped.
+    @staticmethod
+    def insert_user(user: TwitterUser, db_handler: DBHandler, profile_cache: ProfileCache = None):
+        query = TweetDBHandler.user_query()
         values = user.user_tuple()
-        db_handler.execute_query_with_data(query, values)
+        if profile_cache is not None and profile_cache.is_unchanged(values):
+            return True
+        committed = db_handler.execute_query_with_data(query, values)
+        if committed and profile_cache is not None:
+            profile_cache.store([values])
+        return committed
+
+    # Insert the tweets of a batch in one transaction. Tweets that are already stored are ignored so that a single
+    # duplicate does not roll back the whole batch.
+    @staticmethod
+    def insert_tweet_batch(batch: TweetBatch, db_handler: DBHandler):
+        if batch.tweet_count == 0:
+            return True
+        query = TweetDBHandler.tweet_query("INSERT IGNORE")
+        return db_handler.execute_many_with_data(query, batch.tweet_rows())
+
+    # Insert or replace the user profiles of a batch in one transaction. Profiles that are unchanged according to
+    # profile_cache are skipped, and the cache is only updated once the batch has been committed.
+    @staticmethod
+    def insert_user_batch(batch: TweetBatch, db_handler: DBHandler, profile_cache: ProfileCache = None):
+        if batch.user_count == 0:
+            return True
+        rows = batch.user_rows()
+        if profile_cache is not None:
+            rows = profile_cache.changed_rows(rows)
+            if not rows:
+                return True
+        query = TweetDBHandler.user_query()
+        committed = db_handler.execute_many_with_data(query, rows)
+        if committed and profile_cache is not None:
+            profile_cache.store(rows)
+        return committed
+
+    # Insert the (tweet id, keyword id) rows of a batch in one transaction, ignoring the ones already stored.
+    @staticmethod
+    def insert_keyword_batch(batch: TweetBatch, db_handler: DBHandler):
+        if batch.keyword_count == 0:
+            return True
+        return db_handler.execute_many_with_data(TweetDBHandler.keyword_query(), batch.keyword_rows())
+
+    # Write rows with query one row per transaction, after the DB rejected them as a batch, so that only the rows it
+    # refuses are lost. Committed user rows are stored in profile_cache. Returns the refused rows, or None if the DB
+    # could not be reached before every row was tried.
+    @staticmethod
+    def insert_rows(query, rows, db_handler: DBHandler, profile_cache: ProfileCache = None):
+        refused = []
+        for row in rows:
+            committed = db_handler.execute_query_with_data(query, row)
+            if committed is UNREACHABLE:
+                return None
+            if committed is REJECTED:
+                refused.append(row)
+            elif profile_cache is not None:
+                profile_cache.store([row])
+        return refused
+
+    # Write the tweets, users and keywords of a batch, each in one transaction. Tweets and users the DB rejects are
+    # written again one row at a time and the rows it still refuses are moved to the returned TweetBatch. Every part that
+    # has been written is cleared from batch, so the rows left in it could not reach the DB and can be retried.
+    @staticmethod
+    def write_batch(batch: TweetBatch, db_handler: DBHandler, profile_cache: ProfileCache = None):
+        refused = TweetBatch()
+        committed = TweetDBHandler.insert_tweet_batch(batch, db_handler)
+        if committed is REJECTED:
+            rows = TweetDBHandler.insert_rows(TweetDBHandler.tweet_query("INSERT IGNORE"), batch.tweet_rows(),
+                                              db_handler)
+            if rows is not None:
+                for row in rows:
+                    refused.append_tweet(*row)
+                committed = True
+        if committed:
+            batch.clear_tweets()
+
+        committed = TweetDBHandler.insert_user_batch(batch, db_handler, profile_cache)
+        if committed is REJECTED:
+            rows = batch.user_rows()
+            if profile_cache is not None:
+                rows = profile_cache.changed_rows(rows)
+            rows = TweetDBHandler.insert_rows(TweetDBHandler.user_query(), rows, db_handler, profile_cache)
+            if rows is not None:
+                for row in rows:
+                    refused.append_user(*row)
+                committed = True
+        if committed:
+            batch.clear_users()
+
+        # Keyword rows are inserted with INSERT IGNORE, so the DB only rejects them if tweet_keywords is missing or
+        # broken, which writing them one at a time can't help. They are refused as a whole, so that a failed keyword
+        # attribution never holds up the tweets.
+        committed = TweetDBHandler.insert_keyword_batch(batch, db_handler)
+        if committed is REJECTED:
+            refused.keyword_columns = [list(column) for column in batch.keyword_columns]
+        if committed is not UNREACHABLE:
+            batch.clear_keywords()
+        return refused
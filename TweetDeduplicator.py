@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+
+from DBHandler import DBHandler
+from TweetDBHandler import TweetDBHandler
+
+
+# Drops tweets that have already been seen, e.g. tweets re-delivered after a stream reconnect or returned by
+# overlapping backfill queries. Seen tweet ids are kept in insertion order and the oldest ones are forgotten once
+# there are more than max_size of them or they are older than max_age seconds.
+class TweetDeduplicator:
+    def __init__(self, max_size=1000000, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+        self.duplicates = 0
+
+    # Returns True the first time a tweet id is seen and False for duplicates.
+    def add(self, tweet_id):
+        now = time.monotonic()
+        with self.lock:
+            if tweet_id in self.seen:
+                self.duplicates += 1
+                return False
+            self.seen[tweet_id] = now
+            self.__evict(now)
+            return True
+
+    def __evict(self, now):
+        while len(self.seen) > self.max_size:
+            self.seen.popitem(last=False)
+        if self.max_age is not None:
+            while self.seen and now - next(iter(self.seen.values())) > self.max_age:
+                self.seen.popitem(last=False)
+
+    # Drop the tweets of a TwitterJSONWrapper that have already been seen. Returns the number of tweets dropped.
+    # With remember=False the kept tweets are only seen once their ids are passed to remember(), e.g. after they have
+    # been written, so that a page whose write failed isn't dropped as a duplicate when it is fetched again.
+    def filter(self, data, remember=True):
+        if remember:
+            return data.filter_tweets(self.add)
+        kept = set()
+
+        def keep(tweet_id):
+            with self.lock:
+                if tweet_id in self.seen or tweet_id in kept:
+                    self.duplicates += 1
+                    return False
+            kept.add(tweet_id)
+            return True
+
+        return data.filter_tweets(keep)
+
+    # Remember tweet ids as seen.
+    def remember(self, tweet_ids):
+        now = time.monotonic()
+        with self.lock:
+            for tweet_id in tweet_ids:
+                self.seen[tweet_id] = now
+                self.seen.move_to_end(tweet_id)
+            self.__evict(now)
+
+    # Seed the filter with the ids of the most recently created tweets in the tweets table.
+    def seed_from_db(self, db_handler: DBHandler, limit=100000):
+        query = f"SELECT id FROM {TweetDBHandler.DATABASE_NAME}.tweets ORDER BY createdAt DESC LIMIT {int(limit)}"
+        rows = db_handler.execute_read_query(query)
+        if rows is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            # Oldest first, so that they are also the first to be evicted.
+            for row in reversed(rows):
+                self.seen[str(row[0])] = now
+            self.__evict(now)
+        print(f"Deduplicator seeded with {len(rows)} tweet ids")
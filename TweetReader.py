@@ -0,0 +1,58 @@
+from TwitterAPIWrapper import TweetBatch, TWEET_COLUMNS, USER_COLUMNS
+from TweetDBHandler import TweetDBHandler
+from DBHandler import DBHandler
+
+
+# Reads stored tweets back in TweetBatch chunks of up to chunk_size tweets, streamed from the DB with
+# DBHandler.iter_read_query so that large ranges are never loaded at once. batch.tweet_frame() / user_frame() turn a
+# chunk into DataFrames. The queries only filter on createdAt and userId, which are indexed (see
+# TweetDBHandler.TABLES), and return the tweets ordered by createdAt.
+# start and end are datetimes or "YYYY-MM-DD HH:MM:SS" strings; start is inclusive, end exclusive.
+# With profiles, the twitter_profiles row of every author is joined in and added to the users of the chunk, once per
+# chunk.
+class TweetReader:
+    def __init__(self, db_handler: DBHandler, chunk_size=10000):
+        self.db_handler = db_handler
+        self.chunk_size = chunk_size
+
+    # Tweets created between start and end.
+    def tweets_between(self, start, end, profiles=False):
+        return self.__read("t.createdAt >= %s AND t.createdAt < %s", (start, end), profiles)
+
+    # Tweets of user_id, optionally only those created between start and end, with the user's profile.
+    def tweets_by_user(self, user_id, start=None, end=None, profiles=True):
+        condition = "t.userId = %s"
+        data = [str(user_id)]
+        if start is not None:
+            condition += " AND t.createdAt >= %s"
+            data.append(start)
+        if end is not None:
+            condition += " AND t.createdAt < %s"
+            data.append(end)
+        return self.__read(condition, tuple(data), profiles)
+
+    @staticmethod
+    def query(condition, profiles):
+        database = TweetDBHandler.DATABASE_NAME
+        columns = ", ".join(f"t.{column}" for column in TWEET_COLUMNS)
+        if not profiles:
+            return f"SELECT {columns} FROM {database}.tweets t WHERE {condition} ORDER BY t.createdAt"
+        # userId is already selected from tweets
+        columns += ", " + ", ".join(f"p.{column}" for column in USER_COLUMNS[1:])
+        return (f"SELECT {columns}, p.userId IS NOT NULL FROM {database}.tweets t "
+                f"LEFT JOIN {database}.twitter_profiles p ON p.userId = t.userId "
+                f"WHERE {condition} ORDER BY t.createdAt")
+
+    def __read(self, condition, data, profiles):
+        query = TweetReader.query(condition, profiles)
+        tweet_width = len(TWEET_COLUMNS)
+        user_index = TWEET_COLUMNS.index("userId")
+        for rows in self.db_handler.iter_read_query(query, data, self.chunk_size):
+            batch = TweetBatch()
+            users = set()
+            for row in rows:
+                batch.append_tweet(*row[:tweet_width])
+                if profiles and row[-1] and row[user_index] not in users:
+                    users.add(row[user_index])
+                    batch.append_user(row[user_index], *row[tweet_width:-1])
+            yield batch
@@ -1,12 +1,21 @@
 # Fields needed
 # User data: userId, description, friendsCount, followersCount, screenName, statusesCount, location, name
 # Tweet: id, createdAt, text, userId, isRetweet, latitude, longitude, place_country, place_name, place_type
-from typing import List, Optional
+from typing import Dict, List, Optional
 import datetime
+import time
+
+import Metrics
+
+PARSE_SECONDS = Metrics.registry.histogram('parse_seconds', "Time to parse a response with TwitterJSONWrapper")
+TWEETS_PARSED = Metrics.registry.counter('tweets_parsed_total', "Tweets parsed by TwitterJSONWrapper")
 
 
 # Class definition of a Twitter Profile/User
 class TwitterUser:
+    __slots__ = ('description', 'user_id', 'friends_count', 'followers_count', 'screen_name', 'status_count',
+                 'location', 'name')
+
     def __init__(self):
         self.description: Optional[str] = ""
         self.user_id: Optional[str] = None
@@ -41,6 +50,9 @@ class TwitterUser:
 
 # Class definition of a Tweet
 class Tweet:
+    __slots__ = ('tweet_id', 'created_at', 'text', 'user_id', 'is_retweet', 'latitude', 'longitude', 'place_country',
+                 'place_name', 'place_type')
+
     def __init__(self):
         self.tweet_id: Optional[str] = ""
         self.created_at: Optional[str] = None
@@ -78,21 +90,207 @@ class Tweet:
                       self.longitude, self.place_country, self.place_name, self.place_type])
 
 
+# Column names in the order of the tweets, twitter_profiles and tweet_keywords tables.
+TWEET_COLUMNS = ("id", "createdAt", "text", "userId", "isRetweet", "latitude", "longitude", "place_country",
+                 "place_name", "place_type")
+USER_COLUMNS = ("userId", "description", "friendsCount", "followersCount", "screenName", "statusesCount", "location",
+                "name")
+KEYWORD_COLUMNS = ("tweetId", "keywordId")
+
+
+# Columnar batch of tweets and users. Every field is kept in its own list, so a batch of 100k tweets costs ten lists
+# instead of 100k objects, and rows for executemany or the columns of a DataFrame come straight from the lists.
+# The keyword columns hold the (tweet id, keyword id) pairs of the keywords the tweets matched.
+class TweetBatch:
+    __slots__ = ('tweet_columns', 'user_columns', 'keyword_columns')
+    tweet_columns: List[list]
+    user_columns: List[list]
+    keyword_columns: List[list]
+
+    def __init__(self):
+        self.tweet_columns = [[] for _ in TWEET_COLUMNS]
+        self.user_columns = [[] for _ in USER_COLUMNS]
+        self.keyword_columns = [[] for _ in KEYWORD_COLUMNS]
+
+    def __len__(self):
+        return len(self.tweet_columns[0])
+
+    @property
+    def tweet_count(self):
+        return len(self.tweet_columns[0])
+
+    @property
+    def user_count(self):
+        return len(self.user_columns[0])
+
+    @property
+    def keyword_count(self):
+        return len(self.keyword_columns[0])
+
+    # Values are given in the order of TWEET_COLUMNS / USER_COLUMNS.
+    def append_tweet(self, *values):
+        for column, value in zip(self.tweet_columns, values):
+            column.append(value)
+
+    def append_user(self, *values):
+        for column, value in zip(self.user_columns, values):
+            column.append(value)
+
+    def append_keyword(self, tweet_id, keyword_id):
+        self.keyword_columns[0].append(tweet_id)
+        self.keyword_columns[1].append(keyword_id)
+
+    def extend(self, other: 'TweetBatch'):
+        for column, other_column in zip(self.tweet_columns, other.tweet_columns):
+            column.extend(other_column)
+        for column, other_column in zip(self.user_columns, other.user_columns):
+            column.extend(other_column)
+        for column, other_column in zip(self.keyword_columns, other.keyword_columns):
+            column.extend(other_column)
+
+    def clear_tweets(self):
+        for column in self.tweet_columns:
+            column.clear()
+
+    def clear_users(self):
+        for column in self.user_columns:
+            column.clear()
+
+    def clear_keywords(self):
+        for column in self.keyword_columns:
+            column.clear()
+
+    def clear(self):
+        self.clear_tweets()
+        self.clear_users()
+        self.clear_keywords()
+
+    # Keep only the tweets between start and end for which keep(tweet_id) is True. Returns the number of tweets
+    # removed. Keyword rows are not filtered, they are added once the tweets have been deduplicated.
+    def filter_tweets(self, keep, start=0, end=None):
+        mask = [keep(tweet_id) for tweet_id in self.tweet_columns[0][start:end]]
+        removed = mask.count(False)
+        if removed:
+            for column in self.tweet_columns:
+                column[start:end] = [value for value, kept in zip(column[start:end], mask) if kept]
+        return removed
+
+    # Rows as tuples in the column order of the tables, ready for executemany.
+    def tweet_rows(self, start=0, end=None):
+        return list(zip(*(column[start:end] for column in self.tweet_columns)))
+
+    def user_rows(self, start=0, end=None):
+        return list(zip(*(column[start:end] for column in self.user_columns)))
+
+    def keyword_rows(self):
+        return list(zip(*self.keyword_columns))
+
+    def tweets(self, start=0, end=None):
+        tweets = []
+        for row in zip(*(column[start:end] for column in self.tweet_columns)):
+            tweet = Tweet()
+            (tweet.tweet_id, tweet.created_at, tweet.text, tweet.user_id, tweet.is_retweet, tweet.latitude,
+             tweet.longitude, tweet.place_country, tweet.place_name, tweet.place_type) = row
+            tweets.append(tweet)
+        return tweets
+
+    def users(self, start=0, end=None):
+        users = []
+        for row in zip(*(column[start:end] for column in self.user_columns)):
+            user = TwitterUser()
+            (user.user_id, user.description, user.friends_count, user.followers_count, user.screen_name,
+             user.status_count, user.location, user.name) = row
+            users.append(user)
+        return users
+
+    # Approximate size of the text columns in characters.
+    def text_size(self):
+        return (sum(len(text or '') for text in self.tweet_columns[2])
+                + sum(len(description or '') for description in self.user_columns[1]))
+
+    def tweet_frame(self):
+        import pandas as pd
+        return pd.DataFrame(dict(zip(TWEET_COLUMNS, self.tweet_columns)), columns=list(TWEET_COLUMNS))
+
+    def user_frame(self):
+        import pandas as pd
+        return pd.DataFrame(dict(zip(USER_COLUMNS, self.user_columns)), columns=list(USER_COLUMNS))
+
+    def keyword_frame(self):
+        import pandas as pd
+        return pd.DataFrame(dict(zip(KEYWORD_COLUMNS, self.keyword_columns)), columns=list(KEYWORD_COLUMNS))
+
+
 # Class for processing response json objects and converting them into Tweet and TwitterUser objects
+# The rows are appended to a TweetBatch (a new one, or the batch passed in). The tweets and users properties
+# build Tweet / TwitterUser objects for this response on first use.
 class TwitterJSONWrapper:
     # variable type annotations
     response: dict
     includes: dict
     meta: dict
     result_count: int
-    users: List[TwitterUser]
-    tweets: List[Tweet]
+    batch: TweetBatch
+    places_by_id: Dict[str, dict]
+    users_by_id: Dict[str, int]
+    matching_rules: List[str]
 
-    def __init__(self, response_json):
+    def __init__(self, response_json, batch: TweetBatch = None):
         self.response = response_json
-        self.users = []
-        self.tweets = []
+        # Ids of the stream rules the tweet matched, only set on stream items.
+        self.matching_rules = [rule.get('id', '') for rule in response_json.get('matching_rules', [])]
+        self.batch = batch if batch is not None else TweetBatch()
+        self.tweet_start = self.batch.tweet_count
+        self.user_start = self.batch.user_count
+        self.__tweets = None
+        self.__users = None
+        start = time.perf_counter()
         self.__process_response()
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+        self.tweet_end = self.batch.tweet_count
+        self.user_end = self.batch.user_count
+        TWEETS_PARSED.inc(self.tweet_end - self.tweet_start)
+
+    # Wrap rows that were already decoded into batch, e.g. by StreamDecoder.
+    @classmethod
+    def from_batch(cls, batch: TweetBatch, matching_rules=()):
+        data = cls.__new__(cls)
+        data.response = {}
+        data.matching_rules = list(matching_rules)
+        data.meta = {}
+        data.data = []
+        data.includes = {}
+        data.result_count = batch.tweet_count
+        data.next_token = None
+        data.batch = batch
+        data.tweet_start = data.user_start = 0
+        data.tweet_end = batch.tweet_count
+        data.user_end = batch.user_count
+        data.places_by_id = {}
+        data.users_by_id = {user_id: i for i, user_id in enumerate(batch.user_columns[0])}
+        data.__tweets = None
+        data.__users = None
+        return data
+
+    @property
+    def tweets(self) -> List[Tweet]:
+        if self.__tweets is None:
+            self.__tweets = self.batch.tweets(self.tweet_start, self.tweet_end)
+        return self.__tweets
+
+    @property
+    def users(self) -> List[TwitterUser]:
+        if self.__users is None:
+            self.__users = self.batch.users(self.user_start, self.user_end)
+        return self.__users
+
+    # Keep only the tweets of this response for which keep(tweet_id) is True.
+    def filter_tweets(self, keep):
+        removed = self.batch.filter_tweets(keep, self.tweet_start, self.tweet_end)
+        if removed:
+            self.tweet_end -= removed
+            self.__tweets = None
+        return removed
 
     def __process_response(self):
         self.meta = self.response.get('meta', {})
@@ -105,50 +303,62 @@ class TwitterJSONWrapper:
         if type(self.data) == dict:
             self.data = [self.data]
 
+        # Index the expanded places once instead of scanning them for every geo-tagged tweet.
+        self.places_by_id = {place.get('id', ''): place for place in self.includes.get('places', [])}
+        process_date = TwitterJSONWrapper.process_date
+        append_tweet = self.batch.append_tweet
+        append_user = self.batch.append_user
+
         # Process Tweet data
+        user_ids = set()
         tweet_data: dict
         for tweet_data in self.data:
-            tweet = Tweet()
-            tweet.user_id = tweet_data.get('author_id', '')
-            tweet.tweet_id = tweet_data.get('id', '')
-            tweet.created_at = TwitterJSONWrapper.process_date(tweet_data.get('created_at', ''))
-            tweet.text = tweet_data.get('text', '')
-            tweet.is_retweet = 0
+            user_id = tweet_data.get('author_id', '')
+            user_ids.add(user_id)
+            is_retweet = 0
             if 'referenced_tweets' in tweet_data:
                 for referenced_tweet in tweet_data['referenced_tweets']:
                     if referenced_tweet.get('type', '') == 'retweeted':
-                        tweet.is_retweet = 1
+                        is_retweet = 1
                         break
             # TODO LAT LONG
+            place_country = place_name = place_type = None
             if 'geo' in tweet_data:
-                place_id = tweet_data['geo'].get('place_id', '')
-                place: dict
-                for place in self.includes.get('places', []):
-                    if place.get('id', '') == place_id:
-                        tweet.place_name = place.get('full_name', '')
-                        tweet.place_country = place.get('country', '')
-                        tweet.place_type = place.get('place_type', '')
+                place = self.places_by_id.get(tweet_data['geo'].get('place_id', ''))
+                if place is not None:
+                    place_name = place.get('full_name', '')
+                    place_country = place.get('country', '')
+                    place_type = place.get('place_type', '')
 
-            self.tweets.append(tweet)
+            append_tweet(tweet_data.get('id', ''), process_date(tweet_data.get('created_at', '')),
+                         tweet_data.get('text', ''), user_id, is_retweet, None, None,
+                         place_country, place_name, place_type)
 
         # Process User data
-        user_ids = set(tweet.user_id for tweet in self.tweets)
+        self.users_by_id = {}
         user_data: dict
         for user_data in self.includes.get('users', []):
-            if user_data.get('id', '') in user_ids:
-                user = TwitterUser()
-                user.user_id = user_data.get('id', '')
-                user.description = user_data.get('description', '')
+            user_id = user_data.get('id', '')
+            if user_id in user_ids:
                 # TODO def value to use for numeric data
-                user.friends_count = user_data.get('public_metrics', {}).get('following_count', 0)
-                user.followers_count = user_data.get('public_metrics', {}).get('followers_count', 0)
-                user.screen_name = user_data.get('username', '')
-                user.status_count = user_data.get('public_metrics', {}).get('tweet_count', 0)
-                user.location = user_data.get('location', '')
-                user.name = user_data.get('name', '')
-                self.users.append(user)
+                public_metrics = user_data.get('public_metrics', {})
+                self.users_by_id[user_id] = self.batch.user_count
+                append_user(user_id, user_data.get('description', ''), public_metrics.get('following_count', 0),
+                            public_metrics.get('followers_count', 0), user_data.get('username', ''),
+                            public_metrics.get('tweet_count', 0), user_data.get('location', ''),
+                            user_data.get('name', ''))
 
     # Format ISO 8601 date to SQL Datetime
+    # Twitter always sends dates like 2020-03-05T06:43:25.000Z, so the SQL datetime is a slice of the string.
+    # fromisoformat only validates the date and time fields; anything unexpected goes through strptime as before.
     @staticmethod
     def process_date(created_at):
+        if (len(created_at) == 24 and created_at[10] == 'T' and created_at[19] == '.' and created_at[23] == 'Z'
+                and created_at[4] == '-' and created_at[7] == '-' and created_at[13] == ':' and created_at[16] == ':'
+                and created_at[20:23].isdigit()):
+            try:
+                datetime.datetime.fromisoformat(created_at[:19])
+                return f"{created_at[:10]} {created_at[11:19]}"
+            except ValueError:
+                pass
         return datetime.datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y-%m-%d %H:%M:%S")
@@ -1,4 +1,7 @@
-import os
+import argparse
+import calendar
+import random
+import threading
 import time
 import traceback
 from typing import List
@@ -6,26 +9,60 @@ from typing import List
 from TwitterAPI import TwitterAPI, TwitterOAuth, TwitterRequestError, TwitterConnectionError, HydrateType
 
 from TwitterAPIWrapper import TwitterJSONWrapper, Tweet, TwitterUser
+from StreamDecoder import StreamDecoder
 from TweetDBHandler import TweetDBHandler
+from TweetBuffer import TweetBuffer
+from StreamPipeline import StreamPipeline
+from ProfileCache import ProfileCache
+from TweetDeduplicator import TweetDeduplicator
+from RateLimiter import RateLimiter
+from BackfillExecutor import TIME_FORMAT
+from ChunkSink import next_file_index
+from KeywordWatcher import KeywordWatcher
+from KeywordMatcher import KeywordMatcher
 from DBHandler import DBHandler
+from Metrics import MetricsServer, MetricsLogger
+import Metrics
 import stream_utils
-import pandas as pd
+import QueryPacker
+import WriteJournal
+
+RECEIVED = Metrics.registry.counter('stream_items_received_total', "Items read from the stream")
+RECEIVE_SECONDS = Metrics.registry.histogram('stream_receive_seconds', "Time spent waiting for the next stream item")
+STORE_SECONDS = Metrics.registry.histogram('stream_store_seconds', "Time to store one parsed stream item")
+CONNECTIONS = Metrics.registry.counter('stream_connections_total', "Stream connections opened")
+CATCH_UP_SECONDS = Metrics.registry.counter('stream_catch_up_seconds_total', "Length of the gaps searched after a "
+                                            "reconnect")
 
 
 class TwitterStream:
     EXPANSIONS = 'author_id,referenced_tweets.id,referenced_tweets.id.author_id,geo.place_id'
     TWEET_FIELDS = 'created_at,author_id'
     USER_FIELDS = 'location,profile_image_url,verified,public_metrics,description'
+    # Only the user fields that are stored, for raw decoding.
+    RAW_USER_FIELDS = 'location,public_metrics,description'
     PLACE_FIELDS = 'contained_within,country,country_code,full_name,geo,id,name,place_type'
     users: List[TwitterUser]
     tweets: List[Tweet]
 
-    def __init__(self, db: DBHandler = None):
+    # api is anything with TwitterAPI's request method, e.g. a FakeTwitterAPI. By default a TwitterAPI client is
+    # created from creds.txt.
+    def __init__(self, db: DBHandler = None, buffer: TweetBuffer = None, api=None):
         self.db_handler = db
-        # Twitter Credentials are stored in creds.txt
-        o = TwitterOAuth.read_file("creds.txt")
-        self.api = TwitterAPI(o.consumer_key, o.consumer_secret,
-                              auth_type='oAuth2', api_version='2')
+        # When a buffer is given, tweets are written in batches by the buffer instead of one row at a time.
+        self.buffer = buffer
+        # When a pipeline is set, stream() only reads items and the pipeline parses and stores them.
+        self.pipeline: StreamPipeline = None
+        # Skips writing profiles that have not changed since they were last stored.
+        self.profile_cache: ProfileCache = None
+        # Drops tweets that were already delivered, e.g. again after a reconnect.
+        self.deduplicator: TweetDeduplicator = None
+        self.api = api
+        if api is None:
+            # Twitter Credentials are stored in creds.txt
+            o = TwitterOAuth.read_file("creds.txt")
+            self.api = TwitterAPI(o.consumer_key, o.consumer_secret,
+                                  auth_type='oAuth2', api_version='2')
         self.metadata_fields = {
             'expansions': TwitterStream.EXPANSIONS,
             'tweet.fields': TwitterStream.TWEET_FIELDS,
@@ -34,18 +71,46 @@ class TwitterStream:
         }
         self.users = []
         self.tweets = []
+        # Print a count every 10 received items.
+        self.verbose = True
+        # When a decoder is set, stream() reads the raw lines of the response and decodes them with it.
+        self.decoder: StreamDecoder = None
+        # Tweet lookup quota
+        self.lookup_rate_limiter = RateLimiter(max_requests=300, window=900.0, min_interval=0.0, name='lookup')
+        # Keywords of the current rules, searched again for the tweets missed while disconnected.
+        self.keywords = None
+        # createdAt and id of the newest tweet the stream delivered.
+        self.last_tweet_time = None
+        self.last_tweet_id = None
+        self.last_status_code = None
+        self.reconnecting = False
+        # After a reconnect the gap since the last tweet, at most max_catch_up seconds, is searched with
+        # catch_up_endpoint ('tweets/search/all' or 'tweets/search/recent'). None disables the catch-up.
+        self.catch_up_endpoint = 'tweets/search/all'
+        self.max_catch_up = 3600
+        self.catch_up_rate_limiter = RateLimiter(max_requests=300, window=900.0, min_interval=1.0, name='catch_up')
+        self.gaps = []
+        self.gap_lock = threading.Lock()
+        self.catch_up_thread = None
+        # Keyword ids by keyword, a matcher built from them and the keyword ids of every stream rule, for storing
+        # which keywords each tweet matched. Set by set_keywords.
+        self.keyword_ids = {}
+        self.keyword_matcher: KeywordMatcher = None
+        self.rule_keywords = {}
 
     @staticmethod
-    def gen_rules(rules):
+    def gen_rules(rules, pack=False, limit=QueryPacker.STREAM_RULE_LIMIT):
         processed_rules = {"add": []}
-        for rule in rules:
-            processed_rules["add"].append({"value": f'\"{rule}\"'})
+        # Packing puts several keywords in one rule, for when the number of rules is limited.
+        values = QueryPacker.pack_keywords(rules, limit) if pack else [QueryPacker.quote(rule) for rule in rules]
+        for value in values:
+            processed_rules["add"].append({"value": value})
         return processed_rules
 
     # Update streaming rules on Twitter.
-    def update_rules(self, rules):
+    def update_rules(self, rules, pack=False):
         try:
-            r = self.api.request('tweets/search/stream/rules', self.gen_rules(rules))
+            r = self.api.request('tweets/search/stream/rules', self.gen_rules(rules, pack))
             # print(f'[{r.status_code}] RULES: {r.text}')
             print(f'[{r.status_code}]')
 
@@ -76,20 +141,140 @@ class TwitterStream:
         except Exception as e:
             print(e)
 
+    # Bring the stream rules in line with keywords by only adding the missing rules and deleting the ones that are no
+    # longer wanted, in batches of batch_size, instead of deleting and re-adding every rule. New rules are added
+    # before old ones are deleted so that the stream never runs without rules; if an add is rejected, e.g. at the
+    # rule cap or for an invalid rule, nothing is deleted and self.keywords is left as it was. Returns True if the
+    # rules were synced.
+    def sync_rules(self, keywords, pack=False, batch_size=100):
+        if keywords is None:
+            return False
+        try:
+            desired = [rule["value"] for rule in self.gen_rules(keywords, pack)["add"]]
+            current = self.get_rules().get('data', [])
+            current_ids = {}
+            to_delete = []
+            for rule in current:
+                if rule['value'] in current_ids:
+                    # Duplicate rule
+                    to_delete.append(rule['id'])
+                else:
+                    current_ids[rule['value']] = rule['id']
+            desired_values = set(desired)
+            to_add = [value for value in desired if value not in current_ids]
+            to_delete.extend(rule_id for value, rule_id in current_ids.items() if value not in desired_values)
+            for i in range(0, len(to_add), batch_size):
+                r = self.api.request('tweets/search/stream/rules',
+                                     {"add": [{"value": value} for value in to_add[i:i + batch_size]]})
+                print(f'[{r.status_code}]')
+                if not TwitterStream.rules_changed(r):
+                    print("Could not add the stream rules, keeping the old ones")
+                    return False
+            for i in range(0, len(to_delete), batch_size):
+                r = self.api.request('tweets/search/stream/rules', {"delete": {"ids": to_delete[i:i + batch_size]}})
+                print(f'[{r.status_code}]')
+                TwitterStream.rules_changed(r)
+            print(f"Rules synced: {len(to_add)} added, {len(to_delete)} deleted, {len(desired_values)} active")
+            self.keywords = list(keywords)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    # Returns True if a rules request was applied in full. The errors of a failed request are printed. A rule that
+    # exists already is not an error.
+    @staticmethod
+    def rules_changed(r):
+        try:
+            response = r.json()
+        except ValueError:
+            response = {}
+        errors = [error for error in response.get('errors', []) if error.get('title') != 'DuplicateRule']
+        summary = response.get('meta', {}).get('summary', {})
+        for error in errors:
+            print(error)
+        return r.status_code in (200, 201) and not errors and not summary.get('invalid', 0)
+
+    # Sync the rules with keyword_ids, the (keyword, id) pairs read by read_keyword_ids, and tag the tweets that are
+    # stored from now on with the ids of the keywords they matched.
+    def set_keywords(self, keyword_ids, pack=False):
+        if keyword_ids is None:
+            return
+        self.keyword_ids = dict(keyword_ids)
+        self.keyword_matcher = KeywordMatcher(self.keyword_ids)
+        self.sync_rules(list(self.keyword_ids), pack)
+        self.map_rules()
+
+    # Map the id of every stream rule to the ids of the keywords in it.
+    def map_rules(self):
+        try:
+            rules = self.get_rules().get('data', [])
+        except Exception as e:
+            print(e)
+            return
+        self.rule_keywords = {rule['id']: [self.keyword_ids[keyword]
+                                           for keyword in QueryPacker.unquote_keywords(rule['value'])
+                                           if keyword in self.keyword_ids]
+                              for rule in rules}
+
+    # Add a (tweet id, keyword id) row to data's batch for every keyword its tweets matched. For a stream item these
+    # are the keywords of the rules it matched, narrowed down with the keyword matcher when a rule holds several
+    # keywords; tweets from search, which don't say what they matched, are run through the matcher.
+    def tag_keywords(self, data):
+        matcher = self.keyword_matcher
+        if matcher is None:
+            return
+        rule_keywords = set()
+        for rule_id in data.matching_rules:
+            rule_keywords.update(self.rule_keywords.get(rule_id, ()))
+        batch = data.batch
+        if not rule_keywords:
+            matcher.tag_batch(batch, data.tweet_start, data.tweet_end)
+            return
+        tweet_ids = batch.tweet_columns[0]
+        texts = batch.tweet_columns[2]
+        for i in range(data.tweet_start, data.tweet_end):
+            if len(rule_keywords) == 1:
+                keyword_ids = rule_keywords
+            else:
+                # Twitter also matches text the tweet object doesn't hold, e.g. of a quoted tweet or a URL.
+                keyword_ids = (matcher.match(texts[i]) & rule_keywords) or rule_keywords
+            for keyword_id in sorted(keyword_ids):
+                batch.append_keyword(tweet_ids[i], keyword_id)
+
     def stream(self):
         try:
             r = self.api.request('tweets/search/stream', self.metadata_fields,
                                  hydrate_type=HydrateType.NONE)
             print(f'[{r.status_code}] START...')
+            self.last_status_code = r.status_code
+            CONNECTIONS.inc()
+            if self.reconnecting:
+                self.reconnecting = False
+                self.catch_up_gap()
+            items = r if self.decoder is None else self.decoder.items(r)
+            if self.pipeline is not None:
+                self.pipeline.feed(items)
+                return
+            parse = TwitterJSONWrapper if self.decoder is None else self.decoder.decode
             count = 0
-            for item in r:
-                data = TwitterJSONWrapper(item)
-                self.store_tweet_to_db(data)
-                if count % 10 == 0:
+            verbose = self.verbose
+            waiting = time.perf_counter()
+            for item in items:
+                received = time.perf_counter()
+                RECEIVE_SECONDS.observe(received - waiting)
+                RECEIVED.inc()
+                data = parse(item)
+                if data is not None:
+                    self.store_tweet_to_db(data)
+                waiting = time.perf_counter()
+                STORE_SECONDS.observe(waiting - received)
+                if verbose and count % 10 == 0:
                     print(f"Count: {count}")
                 count += 1
 
         except TwitterRequestError as e:
+            self.last_status_code = e.status_code
             print(e.status_code)
             for msg in iter(e):
                 print(msg)
@@ -102,31 +287,127 @@ class TwitterStream:
             print(e)
             traceback.print_exc()
 
+    # Read the stream as raw lines and decode them with a StreamDecoder, without requesting the profile fields that
+    # are never stored.
+    def enable_raw_decoding(self):
+        self.decoder = StreamDecoder()
+        self.metadata_fields['user.fields'] = TwitterStream.RAW_USER_FIELDS
+        print(f"Decoding raw stream lines with {self.decoder.mode}")
+
+    # Remember the newest tweet that was delivered, where the search for missed tweets starts after a reconnect.
+    def __track(self, data):
+        if data.tweet_end == data.tweet_start:
+            return
+        created_at = data.batch.tweet_columns[1]
+        newest = max(range(data.tweet_start, data.tweet_end), key=created_at.__getitem__)
+        with self.gap_lock:
+            if self.last_tweet_time is None or created_at[newest] > self.last_tweet_time:
+                self.last_tweet_time = created_at[newest]
+                self.last_tweet_id = data.batch.tweet_columns[0][newest]
+
+    # Stream until interrupted. A dropped connection is re-opened after an exponential backoff with jitter, which
+    # starts at a minute after a 429 and is reset once a connection has stayed up for stable_after seconds. The
+    # tweets missed in between are searched for by catch_up_gap once the stream is connected again.
+    def run(self, base_delay=1.0, max_delay=320.0, stable_after=60.0):
+        delay = base_delay
+        while True:
+            connected = time.monotonic()
+            if self.stream() == KeyboardInterrupt:
+                return
+            if time.monotonic() - connected >= stable_after:
+                delay = base_delay
+            if self.last_status_code == 429:
+                delay = max(delay, 60.0)
+            wait = delay * random.uniform(0.75, 1.25)
+            print(f"Reconnecting in {wait:.1f}s")
+            try:
+                time.sleep(wait)
+            except KeyboardInterrupt:
+                print("Keyboard interrupt. Stopping now")
+                return
+            delay = min(delay * 2, max_delay)
+            self.reconnecting = True
+
+    # Search the gap between the newest tweet the stream delivered and now for the current keywords, in a background
+    # thread so that the stream keeps running. The found tweets are stored like streamed ones, so the deduplicator
+    # drops those the stream already delivered. Gaps are searched one after the other.
+    def catch_up_gap(self):
+        if self.catch_up_endpoint is None or self.last_tweet_time is None or not self.keywords:
+            return
+        start = calendar.timegm(time.strptime(self.last_tweet_time[:19], "%Y-%m-%d %H:%M:%S"))
+        # The search end_time has to be at least 10 seconds in the past.
+        end = int(time.time()) - 15
+        if end - start > self.max_catch_up:
+            print(f"Gap of {end - start}s since the last tweet, only searching the last {self.max_catch_up}s")
+            start = end - self.max_catch_up
+        if start >= end:
+            return
+        CATCH_UP_SECONDS.inc(end - start)
+        with self.gap_lock:
+            self.gaps.append((time.strftime(TIME_FORMAT, time.gmtime(start)),
+                              time.strftime(TIME_FORMAT, time.gmtime(end))))
+            if self.catch_up_thread is None:
+                self.catch_up_thread = threading.Thread(target=self.__catch_up_loop, name="StreamCatchUp",
+                                                        daemon=True)
+                self.catch_up_thread.start()
+
+    def __catch_up_loop(self):
+        # Imported here because GetOldTweets imports this module.
+        from GetOldTweets import OldTweetGetter
+        while True:
+            with self.gap_lock:
+                if not self.gaps:
+                    self.catch_up_thread = None
+                    return
+                start_time, end_time = self.gaps.pop(0)
+            print(f"Searching for tweets missed between {start_time} and {end_time}")
+            try:
+                getter = OldTweetGetter(self.keywords, deduplicator=self.deduplicator, api=self.api)
+                getter.search_rate_limiter = self.catch_up_rate_limiter
+                getter.get_old_tweets(start_time, end_time, endpoint=self.catch_up_endpoint,
+                                      store=self.store_tweet_to_db)
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+
     def search_tweet(self, tweet_id):
         try:
+            self.lookup_rate_limiter.acquire()
             r = self.api.request(f'tweets/:{tweet_id}', self.metadata_fields,
                                  hydrate_type=HydrateType.NONE)
+            self.lookup_rate_limiter.update(r)
+            if r.status_code != 200:
+                raise TwitterRequestError(r.status_code, r.text)
             print(r.json())
-            print(r.get_quota())
         #             return r.json()
         except TwitterRequestError as e:
             print(e.status_code)
             for msg in iter(e):
                 print(msg)
+            self.lookup_rate_limiter.backoff(e.status_code)
 
         except TwitterConnectionError as e:
             print(e)
+            self.lookup_rate_limiter.backoff()
 
         except Exception as e:
             print(e)
 
     def store_tweet_to_db(self, data):
+        self.__track(data)
         # self.users.extend(data.users)
         # self.tweets.extend(data.tweets)
+        if self.deduplicator is not None:
+            self.deduplicator.filter(data)
+        self.tag_keywords(data)
+        if self.buffer is not None:
+            self.buffer.add(data)
+            return
         for tweet in data.tweets:
             TweetDBHandler.insert_tweet(tweet, self.db_handler)
         for user in data.users:
-            TweetDBHandler.insert_user(user, self.db_handler)
+            TweetDBHandler.insert_user(user, self.db_handler, self.profile_cache)
+        TweetDBHandler.insert_keyword_batch(data.batch, self.db_handler)
         #     Dump to CSV files for debugging
         # if len(self.tweets) > 50:
         #     self.dump_to_file()
@@ -135,43 +416,98 @@ class TwitterStream:
 
     # Stores tweets and users in csv files.
     def dump_to_file(self):
+        import pandas as pd
         print("Dumping to CSV files")
         user_df = pd.DataFrame([user.user_dict() for user in self.users])
         tweet_df = pd.DataFrame([tweet.tweet_dict() for tweet in self.tweets])
-        user_file_count = tweet_file_count = 0
-
-        while os.path.isfile(f"users_{user_file_count}.csv"):
-            user_file_count += 1
-        while os.path.isfile(f"tweets_{tweet_file_count}.csv"):
-            tweet_file_count += 1
+        user_file_count = next_file_index("users", "csv")
+        tweet_file_count = next_file_index("tweets", "csv")
         print(f"tweets_{tweet_file_count}.csv", f"users_{user_file_count}.csv")
         user_df.to_csv(f"users_{user_file_count}.csv", index=False)
         tweet_df.to_csv(f"tweets_{tweet_file_count}.csv", index=False)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Stream tweets matching the keywords in the database to MySQL.")
+    parser.add_argument('--quiet', action='store_true', help="don't print a count every 10 tweets")
+    parser.add_argument('--raw', action='store_true',
+                        help="decode the raw stream lines with msgspec or orjson when they are installed")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--metrics-interval', type=float, default=60.0,
+                        help="seconds between metrics log lines, 0 to disable")
+    parser.add_argument('--journal', default="journal",
+                        help="directory of the write journal that keeps tweets while the DB is down, '' to disable")
+    parser.add_argument('--journal-max-mb', type=int, default=1024, help="size limit of the write journal")
+    parser.add_argument('--fsync', choices=(WriteJournal.ALWAYS, WriteJournal.INTERVAL, WriteJournal.NEVER),
+                        default=WriteJournal.INTERVAL, help="when to fsync the write journal")
+    args = parser.parse_args()
+    if args.metrics_port is not None:
+        MetricsServer(args.metrics_port).start()
+    metrics_logger = None
+    if args.metrics_interval > 0:
+        metrics_logger = MetricsLogger(args.metrics_interval)
+        metrics_logger.start()
+
     db_credentials = stream_utils.read_database_credentials('db_creds.json')
 
     db = DBHandler()
     # Update credentials here
     TweetDBHandler.DATABASE_NAME = db_credentials['db_name']
-    db.create_db_connection(db_credentials['local_host'], db_credentials['local_user'],
-                            db_credentials['local_password'], db_credentials['db_name'])
-    streamer = TwitterStream(db)
-    streamer.delete_rules()
-    keywords = read_keywords(db)
-    streamer.update_rules(keywords)
-    while streamer.stream() != KeyboardInterrupt:
-        print("Sleeping")
-        time.sleep(5)
+    # Pooled so that the buffer's flush thread and keyword reads don't share one connection.
+    db.create_db_pool(db_credentials['local_host'], db_credentials['local_user'],
+                      db_credentials['local_password'], db_credentials['db_name'],
+                      pool_size=db_credentials.get('pool_size', 5))
+    # Creates tweet_keywords and the indexes on databases set up before they were added.
+    TweetDBHandler.create_tables(db)
+    journal = None
+    if args.journal:
+        journal = WriteJournal.WriteJournal(db, args.journal, max_bytes=args.journal_max_mb << 20, fsync=args.fsync)
+        journal.start()
+    buffer = TweetBuffer(db, max_pending_rows=50000, profile_cache=ProfileCache(), journal=journal,
+                         journal_rows=25000)
+    streamer = TwitterStream(db, buffer)
+    streamer.deduplicator = TweetDeduplicator()
+    streamer.deduplicator.seed_from_db(db)
+    streamer.verbose = not args.quiet
+    if args.raw:
+        streamer.enable_raw_decoding()
+    streamer.pipeline = StreamPipeline(streamer.store_tweet_to_db, verbose=streamer.verbose,
+                                       parse=streamer.decoder.decode if args.raw else TwitterJSONWrapper)
+    streamer.pipeline.start()
+    streamer.set_keywords(read_keyword_ids(db))
+    # Apply changes to the twitter_keywords table while the stream keeps running.
+    watcher = KeywordWatcher(lambda: read_keyword_ids(db), streamer.set_keywords)
+    watcher.start()
+    try:
+        streamer.run()
+    finally:
+        watcher.stop()
+        # Write out the tweets that are still queued or buffered before exiting.
+        streamer.pipeline.stop()
+        buffer.close()
+        if journal is not None:
+            journal.stop()
+        if metrics_logger is not None:
+            metrics_logger.stop()
 
 
 def read_keywords(db_handler: DBHandler):
     read_keyword_query = f"SELECT keyword from {TweetDBHandler.DATABASE_NAME}.twitter_keywords"
     keyword_tuples = db_handler.execute_read_query(read_keyword_query)
+    if keyword_tuples is None:
+        return None
     keywords = [key[0] for key in keyword_tuples]
     return keywords
 
 
+# (keyword, id) pairs of the twitter_keywords table.
+def read_keyword_ids(db_handler: DBHandler):
+    rows = db_handler.execute_read_query(f"SELECT keyword, id FROM {TweetDBHandler.DATABASE_NAME}.twitter_keywords")
+    if rows is None:
+        return None
+    return [(keyword, keyword_id) for keyword, keyword_id in rows]
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,246 @@
+import json
+import os
+import re
+import threading
+import time
+import traceback
+
+from TwitterAPIWrapper import TweetBatch
+from TweetDBHandler import TweetDBHandler
+import Metrics
+
+# fsync policies
+ALWAYS = 'always'  # fsync after every append
+INTERVAL = 'interval'  # fsync at most every fsync_interval seconds
+NEVER = 'never'  # leave it to the OS
+
+
+# Append-only on-disk journal for rows that could not be written to the DB. Every append is one JSON line holding
+# the tweet, user and keyword columns of a TweetBatch, written to numbered segment files journal_N.jsonl in
+# directory. A new segment is started once the current one reaches segment_bytes, and appends are refused (and
+# counted in dropped_rows, for the caller to keep or drop) once the journal holds max_bytes. The journal then
+# reports itself full until a replayed segment has been deleted. Rows left over from a previous run are replayed
+# first.
+# start() runs a replayer that waits until the DB is healthy and then writes the journal back in order, replay_rows
+# rows at a time, deleting every segment once it has been replayed. Replaying a segment again after a crash is
+# harmless: tweets are inserted with INSERT IGNORE and profiles are replaced. Rows the DB rejects are written again
+# one at a time, and the ones it still refuses are set aside in rejected.jsonl instead of stopping the replay.
+class WriteJournal:
+    def __init__(self, db_handler, directory="journal", max_bytes=1 << 30, segment_bytes=64 << 20,
+                 fsync=INTERVAL, fsync_interval=1.0, replay_rows=5000, replay_interval=1.0):
+        if fsync not in (ALWAYS, INTERVAL, NEVER):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.db_handler = db_handler
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.replay_rows = replay_rows
+        self.replay_interval = replay_interval
+        self.lock = threading.Lock()
+        self.file = None
+        self.last_fsync = time.monotonic()
+        # Segment indexes in order, with their rows and bytes.
+        self.segments = []
+        self.segment_rows = {}
+        self.segment_sizes = {}
+        self.rows = 0
+        self.bytes = 0
+        # Offset of the next record to replay in the oldest segment.
+        self.replay_offset = 0
+        self.dropped_rows = 0
+        self.replayed_rows = 0
+        self.rejected_rows = 0
+        # Set when an append was refused, cleared once replaying has made room.
+        self.full = False
+        self.stop_event = threading.Event()
+        self.replay_event = threading.Event()
+        self.replay_thread = None
+        os.makedirs(directory, exist_ok=True)
+        self.__load_segments()
+        Metrics.registry.gauge('journal_rows', "Tweet, user and keyword rows waiting in the write journal",
+                               function=lambda: self.rows)
+        Metrics.registry.gauge('journal_bytes', "Size of the write journal", function=lambda: self.bytes)
+        self.dropped_counter = Metrics.registry.counter('journal_dropped_rows_total', "Rows refused by the full "
+                                                        "write journal")
+        self.replayed_counter = Metrics.registry.counter('journal_replayed_rows_total', "Rows replayed from the write "
+                                                         "journal to the DB")
+
+    def __segment_name(self, index):
+        return os.path.join(self.directory, f"journal_{index}.jsonl")
+
+    def __load_segments(self):
+        pattern = re.compile(r"journal_(\d+)\.jsonl$")
+        indexes = sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+        for index in indexes:
+            rows = 0
+            with open(self.__segment_name(index), "rb") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record cut short by a crash
+                        continue
+                    # Records written before keywords were journaled have no keyword columns.
+                    rows += sum(len(columns[0]) for columns in record)
+            self.__add_segment(index, rows, os.path.getsize(self.__segment_name(index)))
+        if self.rows:
+            print(f"Write journal has {self.rows} rows in {len(self.segments)} segments to replay")
+
+    def __add_segment(self, index, rows, size):
+        self.segments.append(index)
+        self.segment_rows[index] = rows
+        self.segment_sizes[index] = size
+        self.rows += rows
+        self.bytes += size
+
+    # Rows (tweets, users and keywords) waiting in the journal.
+    def depth(self):
+        return self.rows
+
+    def is_full(self):
+        return self.full and self.rows > 0
+
+    # Append the rows of batch. Returns False if the journal is full and the rows were not written.
+    def append(self, batch: TweetBatch):
+        rows = batch.tweet_count + batch.user_count + batch.keyword_count
+        if rows == 0:
+            return True
+        line = json.dumps([batch.tweet_columns, batch.user_columns, batch.keyword_columns], separators=(',', ':'),
+                          default=str) + "\n"
+        line = line.encode("utf-8")
+        with self.lock:
+            if self.bytes + len(line) > self.max_bytes:
+                self.full = True
+                self.dropped_rows += rows
+                self.dropped_counter.inc(rows)
+                return False
+            if self.file is None or self.segment_sizes[self.segments[-1]] >= self.segment_bytes:
+                self.__open_segment()
+            index = self.segments[-1]
+            self.file.write(line)
+            self.file.flush()
+            now = time.monotonic()
+            if self.fsync == ALWAYS or (self.fsync == INTERVAL and now - self.last_fsync >= self.fsync_interval):
+                os.fsync(self.file.fileno())
+                self.last_fsync = now
+            self.segment_rows[index] += rows
+            self.segment_sizes[index] += len(line)
+            self.rows += rows
+            self.bytes += len(line)
+        self.replay_event.set()
+        return True
+
+    def __open_segment(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+        index = self.segments[-1] + 1 if self.segments else 0
+        self.file = open(self.__segment_name(index), "ab")
+        self.__add_segment(index, 0, 0)
+
+    # Write the next replay_rows rows (at least one record) of the oldest segment to the DB. Returns the number of
+    # rows replayed, 0 if the journal is empty or the DB could not be reached.
+    def replay_batch(self):
+        with self.lock:
+            if not self.segments:
+                return 0
+            index = self.segments[0]
+            offset = self.replay_offset
+            writing = self.file is not None and index == self.segments[-1]
+            if writing:
+                self.file.flush()
+        batch = TweetBatch()
+        with open(self.__segment_name(index), "rb") as file:
+            file.seek(offset)
+            while batch.tweet_count + batch.user_count + batch.keyword_count < self.replay_rows:
+                line = file.readline()
+                if not line.endswith(b"\n"):
+                    # End of the segment or a record that is still being written. In a segment that is no longer
+                    # written to, the last record was cut short by a crash and is skipped.
+                    if line and not writing:
+                        offset = file.tell()
+                    break
+                offset = file.tell()
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                # Records written before keywords were journaled have no keyword columns.
+                for columns, values in zip((batch.tweet_columns, batch.user_columns, batch.keyword_columns), record):
+                    for column, column_values in zip(columns, values):
+                        column.extend(column_values)
+        rows = batch.tweet_count + batch.user_count + batch.keyword_count
+        refused = TweetDBHandler.write_batch(batch, self.db_handler)
+        if refused.tweet_count or refused.user_count or refused.keyword_count:
+            self.__quarantine(refused)
+        if batch.tweet_count or batch.user_count or batch.keyword_count:
+            # The DB could not be reached, the records are replayed again.
+            return 0
+        with self.lock:
+            self.replay_offset = offset
+            self.segment_rows[index] -= rows
+            self.rows -= rows
+            self.replayed_rows += rows
+            self.replayed_counter.inc(rows)
+            if offset >= self.segment_sizes[index]:
+                self.__remove_oldest_segment()
+        return rows
+
+    # Rows the DB refuses are kept in rejected.jsonl, in the format of the segments but never replayed, so that one
+    # bad row can't hold up the rest of the journal.
+    def __quarantine(self, batch: TweetBatch):
+        rows = batch.tweet_count + batch.user_count + batch.keyword_count
+        line = json.dumps([batch.tweet_columns, batch.user_columns, batch.keyword_columns], separators=(',', ':'),
+                          default=str) + "\n"
+        with open(os.path.join(self.directory, "rejected.jsonl"), "a", encoding="utf-8") as file:
+            file.write(line)
+        self.rejected_rows += rows
+        print(f"Moved {rows} rows the DB refused to {os.path.join(self.directory, 'rejected.jsonl')}")
+
+    def __remove_oldest_segment(self):
+        index = self.segments.pop(0)
+        if self.file is not None and not self.segments:
+            # The segment that is being appended to, the next append starts a new one.
+            self.file.close()
+            self.file = None
+        self.rows -= self.segment_rows.pop(index)
+        self.bytes -= self.segment_sizes.pop(index)
+        self.replay_offset = 0
+        self.full = False
+        os.remove(self.__segment_name(index))
+
+    def start(self):
+        self.stop_event.clear()
+        self.replay_thread = threading.Thread(target=self.__replay_loop, name="JournalReplay", daemon=True)
+        self.replay_thread.start()
+
+    # Stop the replayer. Rows that have not been replayed stay in the journal for the next run.
+    def stop(self):
+        self.stop_event.set()
+        self.replay_event.set()
+        if self.replay_thread is not None:
+            self.replay_thread.join()
+            self.replay_thread = None
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+        print(f"Write journal: {self.replayed_rows} rows replayed, {self.rows} rows left, "
+              f"{self.dropped_rows} rows refused while full, {self.rejected_rows} rows rejected by the DB")
+
+    def __replay_loop(self):
+        while not self.stop_event.is_set():
+            if self.rows == 0:
+                self.replay_event.wait(self.replay_interval)
+                self.replay_event.clear()
+                continue
+            try:
+                if not self.db_handler.is_healthy() or self.replay_batch() == 0:
+                    self.stop_event.wait(self.replay_interval)
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+                self.stop_event.wait(self.replay_interval)
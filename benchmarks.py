@@ -0,0 +1,467 @@
+import contextlib
+import datetime
+import functools
+import io
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from math import ceil
+
+from TwitterAPIWrapper import TwitterJSONWrapper, TweetBatch, Tweet, TwitterUser
+from FakeTwitterAPI import FakeTwitterAPI, make_page, make_stream_items, make_search_pages
+from SQLiteDBHandler import SQLiteDBHandler
+from TweetDBHandler import TweetDBHandler
+from TweetBuffer import TweetBuffer
+from StreamPipeline import StreamPipeline
+from StreamDecoder import StreamDecoder
+import json
+import QueryPacker
+from KeywordMatcher import KeywordMatcher
+
+
+# Micro-benchmarks for the ingest hot paths. Run benchmarks.py to print the results.
+
+# The TwitterJSONWrapper parsing code before the place index and the fast date parser, kept as the baseline.
+def legacy_parse(response):
+    includes = response.get('includes', {})
+    tweets = []
+    for tweet_data in response.get('data', []):
+        tweet = Tweet()
+        tweet.user_id = tweet_data.get('author_id', '')
+        tweet.tweet_id = tweet_data.get('id', '')
+        tweet.created_at = datetime.datetime.strptime(tweet_data.get('created_at', ''),
+                                                      "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y-%m-%d %H:%M:%S")
+        tweet.text = tweet_data.get('text', '')
+        tweet.is_retweet = 0
+        if 'referenced_tweets' in tweet_data:
+            for referenced_tweet in tweet_data['referenced_tweets']:
+                if referenced_tweet.get('type', '') == 'retweeted':
+                    tweet.is_retweet = 1
+                    break
+        if 'geo' in tweet_data:
+            place_id = tweet_data['geo'].get('place_id', '')
+            for place in includes.get('places', []):
+                if place.get('id', '') == place_id:
+                    tweet.place_name = place.get('full_name', '')
+                    tweet.place_country = place.get('country', '')
+                    tweet.place_type = place.get('place_type', '')
+        tweets.append(tweet)
+    user_ids = set(tweet.user_id for tweet in tweets)
+    users = []
+    for user_data in includes.get('users', []):
+        if user_data.get('id', '') in user_ids:
+            user = TwitterUser()
+            user.user_id = user_data.get('id', '')
+            user.description = user_data.get('description', '')
+            user.friends_count = user_data.get('public_metrics', {}).get('following_count', 0)
+            user.followers_count = user_data.get('public_metrics', {}).get('followers_count', 0)
+            user.screen_name = user_data.get('username', '')
+            user.status_count = user_data.get('public_metrics', {}).get('tweet_count', 0)
+            user.location = user_data.get('location', '')
+            user.name = user_data.get('name', '')
+            users.append(user)
+    return tweets, users
+
+
+# Run function repeat times and return the best time per call in seconds.
+def best_time(function, repeat=5, number=20):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+# Median and 99th percentile of samples.
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def bench_wrapper():
+    page = make_page()
+    legacy_tweets, legacy_users = legacy_parse(page)
+    data = TwitterJSONWrapper(page)
+    assert [tweet.tweet_tuple() for tweet in data.tweets] == [tweet.tweet_tuple() for tweet in legacy_tweets]
+    assert [user.user_tuple() for user in data.users] == [user.user_tuple() for user in legacy_users]
+
+    legacy = best_time(lambda: legacy_parse(page))
+    current = best_time(lambda: TwitterJSONWrapper(page))
+    print(f"TwitterJSONWrapper, 500 tweet page: legacy {legacy * 1000:.2f} ms, current {current * 1000:.2f} ms, "
+          f"{legacy / current:.1f}x faster, {len(page['data']) / current:,.0f} tweets/sec")
+
+    dates = [tweet['created_at'] for tweet in page['data']]
+    legacy = best_time(lambda: [datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%fZ").strftime(
+        "%Y-%m-%d %H:%M:%S") for date in dates])
+    current = best_time(lambda: [TwitterJSONWrapper.process_date(date) for date in dates])
+    items = make_stream_items(5000)
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        TwitterJSONWrapper(item)
+        latencies.append(time.perf_counter() - start)
+    p50, p99 = percentiles(latencies)
+    print(f"TwitterJSONWrapper, stream items: {len(items) / sum(latencies):,.0f} tweets/sec, "
+          f"latency p50 {p50 * 1e6:.1f} us, p99 {p99 * 1e6:.1f} us")
+
+    print(f"process_date: legacy {legacy / len(dates) * 1e6:.2f} us, current {current / len(dates) * 1e6:.2f} us, "
+          f"{legacy / current:.1f}x faster")
+
+
+# Raw stream lines decoded with json.loads and TwitterJSONWrapper versus the StreamDecoder, which uses msgspec or
+# orjson when installed. Both must produce the same rows.
+def bench_stream_decode(count=5000):
+    lines = [json.dumps(item).encode("utf-8") for item in make_stream_items(count)]
+    decoder = StreamDecoder()
+    for line in lines[:500]:
+        expected = TwitterJSONWrapper(json.loads(line)).batch
+        decoded = decoder.decode(line).batch
+        assert decoded.tweet_rows() == expected.tweet_rows() and decoded.user_rows() == expected.user_rows()
+
+    legacy = best_time(lambda: [TwitterJSONWrapper(json.loads(line)) for line in lines], repeat=3, number=1)
+    current = best_time(lambda: [decoder.decode(line) for line in lines], repeat=3, number=1)
+    print(f"Raw stream lines: json + TwitterJSONWrapper {count / legacy:,.0f} tweets/sec, "
+          f"StreamDecoder ({decoder.mode}) {count / current:,.0f} tweets/sec, {legacy / current:.1f}x faster")
+
+
+# Memory of holding 100k parsed tweets as objects versus one columnar TweetBatch.
+def bench_batch_memory(pages=200):
+    page = make_page()
+
+    def objects():
+        tweets, users = [], []
+        for _ in range(pages):
+            data = TwitterJSONWrapper(page)
+            tweets.extend(data.tweets)
+            users.extend(data.users)
+        return tweets, users
+
+    def columns():
+        batch = TweetBatch()
+        for _ in range(pages):
+            TwitterJSONWrapper(page, batch)
+        return batch
+
+    results = {}
+    for name, function in (("objects", objects), ("TweetBatch", columns)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        held = function()
+        elapsed = time.perf_counter() - start
+        results[name] = (tracemalloc.get_traced_memory()[0], elapsed)
+        del held
+        tracemalloc.stop()
+    for name, (size, elapsed) in results.items():
+        print(f"{pages * len(page['data']):,} tweets as {name}: {size / 2 ** 20:.1f} MiB held, {elapsed:.2f} s")
+
+
+# The greedy keyword packing of OldTweetGetter.set_queries before QueryPacker, kept as the baseline.
+def legacy_set_queries(keywords):
+    total_keyword_character_length = sum((len(keyword) + 4) for keyword in keywords)
+    number_of_queries_required = ceil(total_keyword_character_length / 1024)
+    avg_query_length = ceil(total_keyword_character_length / number_of_queries_required)
+    query = ""
+    rule_strings = [query]
+    for keyword in keywords:
+        if len(query) > avg_query_length:
+            query = f"\"{keyword}\" OR "
+            rule_strings.append(query)
+        else:
+            query += f"\"{keyword}\" OR "
+            rule_strings[-1] = query
+    return [query[:-4] for query in rule_strings]
+
+
+def make_keywords(count, seed=0):
+    rng = random.Random(seed)
+    words = ['vape', 'juul', 'nicotine', 'e-cig', 'puff bar', 'salt nic', 'pod', 'mods', 'cloud', 'flavor', 'ban']
+    keywords = set()
+    while len(keywords) < count:
+        keywords.add(' '.join(rng.choice(words) for _ in range(rng.randint(1, 6))) + str(rng.randint(0, 10 ** 6)))
+    return sorted(keywords)
+
+
+# Check that the packed queries hold every keyword exactly once and fit the limit, and compare the number of
+# query strings with the greedy packing and the lower bound.
+def bench_query_packing():
+    for count, limit in ((500, QueryPacker.SEARCH_QUERY_LIMIT), (5000, QueryPacker.SEARCH_QUERY_LIMIT),
+                         (5000, QueryPacker.STREAM_RULE_LIMIT), (20000, QueryPacker.SEARCH_QUERY_LIMIT)):
+        keywords = make_keywords(count, seed=count)
+        start = time.perf_counter()
+        queries = QueryPacker.pack_keywords(keywords, limit)
+        elapsed = time.perf_counter() - start
+        assert all(len(query) <= limit for query in queries)
+        packed = [keyword for query in queries for keyword in query.split(QueryPacker.SEPARATOR)]
+        assert sorted(packed) == sorted(QueryPacker.quote(keyword) for keyword in keywords)
+        legacy = legacy_set_queries(keywords)
+        too_long = sum(1 for query in legacy if len(query) > limit)
+        print(f"{QueryPacker.packing_report(keywords, queries, limit)}; greedy: {len(legacy)} strings, "
+              f"{too_long} over the limit; packed in {elapsed * 1000:.0f} ms")
+
+
+# Keyword attribution of page texts with the Aho-Corasick matcher against one regular expression per keyword, the
+# way a LIKE '%kw%' scan per keyword would look at every text.
+def bench_keyword_matching(pages=4):
+    texts = [tweet['text'] for i in range(pages) for tweet in make_page(seed=i)['data']]
+    for count in (100, 1000):
+        keywords = make_keywords(count, seed=count) + ['vaping', 'juul']
+        keyword_ids = {keyword: i for i, keyword in enumerate(keywords)}
+        start = time.perf_counter()
+        matcher = KeywordMatcher(keyword_ids)
+        built = time.perf_counter() - start
+        matched = best_time(lambda: [matcher.match(text) for text in texts], repeat=3, number=1)
+        patterns = [(re.compile(r"(?<!\w)" + re.escape(keyword.casefold()) + r"(?!\w)"), keyword_id)
+                    for keyword, keyword_id in keyword_ids.items()]
+        scanned = best_time(lambda: [{keyword_id for pattern, keyword_id in patterns if pattern.search(text.casefold())}
+                                     for text in texts], repeat=3, number=1)
+        print(f"Keyword matching, {len(keywords)} keywords: matcher {len(texts) / matched:,.0f} tweets/sec "
+              f"(built in {built * 1000:.0f} ms), regex per keyword {len(texts) / scanned:,.0f} tweets/sec, "
+              f"{scanned / matched:.1f}x faster")
+
+
+def sqlite_db():
+    db = SQLiteDBHandler()
+    db.create_tables(TweetDBHandler.DATABASE_NAME)
+    return db
+
+
+# TweetDBHandler writes into an in-memory SQLite database: one transaction per row versus one executemany
+# transaction per 500 tweet batch. SQLite has no network round trip, so against MySQL the gap is larger.
+def bench_db_writes(pages=10):
+    data = [TwitterJSONWrapper(make_page(seed=i, first_id=1235000000000000000 + i * 500)) for i in range(pages)]
+    tweet_count = sum(page.batch.tweet_count for page in data)
+
+    db = sqlite_db()
+    latencies = []
+    start = time.perf_counter()
+    for page in data:
+        for tweet in page.tweets:
+            row_start = time.perf_counter()
+            TweetDBHandler.insert_tweet(tweet, db)
+            latencies.append(time.perf_counter() - row_start)
+        for user in page.users:
+            TweetDBHandler.insert_user(user, db)
+    per_row = time.perf_counter() - start
+    p50, p99 = percentiles(latencies)
+    print(f"TweetDBHandler per row: {tweet_count / per_row:,.0f} tweets/sec, "
+          f"insert latency p50 {p50 * 1e6:.0f} us, p99 {p99 * 1e6:.0f} us")
+
+    db = sqlite_db()
+    latencies = []
+    start = time.perf_counter()
+    for page in data:
+        batch_start = time.perf_counter()
+        assert TweetDBHandler.insert_tweet_batch(page.batch, db)
+        assert TweetDBHandler.insert_user_batch(page.batch, db)
+        latencies.append(time.perf_counter() - batch_start)
+    batched = time.perf_counter() - start
+    p50, p99 = percentiles(latencies)
+    stored = db.execute_read_query(f"SELECT COUNT(*) FROM {TweetDBHandler.DATABASE_NAME}.tweets")[0][0]
+    assert stored == tweet_count
+    print(f"TweetDBHandler batches: {tweet_count / batched:,.0f} tweets/sec, {per_row / batched:.1f}x faster, "
+          f"batch latency p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms")
+
+
+# The whole TwitterStream.stream path, from reading items of a FakeTwitterAPI stream to committing them to an
+# in-memory SQLite database: per-row inserts, the TweetBuffer, and the StreamPipeline with the TweetBuffer.
+# Latency is the time between consecutive items being stored.
+def bench_stream(count=20000):
+    from TwitterStream import TwitterStream
+
+    items = make_stream_items(count)
+    for name in ("per row", "TweetBuffer", "TweetBuffer, raw lines", "StreamPipeline"):
+        db = sqlite_db()
+        buffer = TweetBuffer(db) if name != "per row" else None
+        streamer = TwitterStream(db, buffer, api=FakeTwitterAPI(items))
+        streamer.verbose = False
+        if name == "TweetBuffer, raw lines":
+            streamer.decoder = StreamDecoder()
+        latencies = []
+        store = streamer.store_tweet_to_db
+
+        def timed_store(data):
+            store(data)
+            latencies.append(time.perf_counter())
+
+        streamer.store_tweet_to_db = timed_store
+        if name == "StreamPipeline":
+            streamer.pipeline = StreamPipeline(timed_store, verbose=False)
+            streamer.pipeline.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            streamer.stream()
+            if streamer.pipeline is not None:
+                streamer.pipeline.stop()
+            if buffer is not None:
+                buffer.close()
+        elapsed = time.perf_counter() - start
+        stored = db.execute_read_query(f"SELECT COUNT(*) FROM {TweetDBHandler.DATABASE_NAME}.tweets")[0][0]
+        assert stored == count, stored
+        gaps = [b - a for a, b in zip([start] + latencies, latencies)]
+        p50, p99 = percentiles(gaps)
+        print(f"TwitterStream.stream, {name}: {count / elapsed:,.0f} tweets/sec, "
+              f"item latency p50 {p50 * 1e6:.0f} us, p99 {p99 * 1e6:.0f} us")
+
+
+# BackfillExecutor against the fake search endpoint with no rate limit: every query is paginated to its last page
+# and completed, every stored page is checkpointed, and a query whose requests keep failing is given up after
+# max_errors errors while the others finish.
+def bench_backfill_executor(pages=20, queries=3, max_errors=3):
+    from BackfillExecutor import BackfillExecutor, QueryCursor
+    from RateLimiter import RateLimiter
+
+    search_pages = {}
+    for i in range(queries):
+        for token, page in make_search_pages(pages, 100, seed=i * pages).items():
+            search_pages[(f"query {i}", token)] = page
+    stored = []
+    checkpoints = []
+    executor = BackfillExecutor(FakeTwitterAPI(search_pages=search_pages), {}, lambda data: stored.append(data),
+                                workers=2, rate_limiter=RateLimiter(min_interval=0.0, base_backoff=0.0),
+                                max_errors=max_errors, checkpoint=checkpoints.append)
+    cursors = [QueryCursor(f"query {i}") for i in range(queries)] + [QueryCursor("unknown query")]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        executor.run(cursors)
+    elapsed = time.perf_counter() - start
+    assert all(cursor.completed and cursor.pages == pages for cursor in cursors[:queries])
+    assert cursors[-1].failed and not cursors[-1].completed and cursors[-1].errors == max_errors
+    assert len(stored) == len(checkpoints) == pages * queries
+    assert sum(page.batch.tweet_count for page in stored) == pages * queries * 100
+    print(f"BackfillExecutor: {len(stored)} pages of {queries} queries in {elapsed * 1000:.0f} ms "
+          f"({len(stored) / elapsed:,.0f} pages/sec), failing query given up after {cursors[-1].errors} errors")
+
+
+# A sink that keeps the ids it was given and fails the write number fail_on.
+class FlakySink:
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.writes = 0
+        self.tweets_written = 0
+        self.users_written = 0
+        self.tweet_ids = set()
+        self.user_ids = set()
+
+    def write(self, batch):
+        self.writes += 1
+        if self.writes == self.fail_on:
+            return False
+        self.tweets_written += batch.tweet_count
+        self.users_written += batch.user_count
+        self.tweet_ids.update(batch.tweet_columns[0])
+        self.user_ids.update(batch.user_columns[0])
+        return True
+
+    def close(self):
+        pass
+
+
+# OldTweetGetter.get_old_tweets with a sink that fails one page write: the page is fetched again and every tweet and
+# user of the run still reaches the sink, as in a run whose writes all succeed.
+def bench_backfill_retry(pages=10, fail_on=2):
+    from GetOldTweets import OldTweetGetter
+    from RateLimiter import RateLimiter
+    from TweetDeduplicator import TweetDeduplicator
+    from ProfileCache import ProfileCache
+
+    search_pages = make_search_pages(pages, 100)
+    sinks = [FlakySink(), FlakySink(fail_on)]
+    start = time.perf_counter()
+    for sink in sinks:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            getter = OldTweetGetter(['vape'], ProfileCache(), TweetDeduplicator(), sink,
+                                    api=FakeTwitterAPI(search_pages=search_pages))
+            getter.search_rate_limiter = RateLimiter(max_requests=10 ** 9, window=900.0, min_interval=0.0,
+                                                     base_backoff=0.0)
+            getter.get_old_tweets('2020-03-05T06:43:25Z', '2020-03-06T06:43:25Z')
+    elapsed = time.perf_counter() - start
+    control, flaky = sinks
+    assert flaky.writes == control.writes + 1
+    assert flaky.tweet_ids == control.tweet_ids and flaky.user_ids == control.user_ids
+    print(f"Backfill retry: {len(flaky.tweet_ids)} tweets and {len(flaky.user_ids)} users written after a failed "
+          f"page write, {elapsed * 1000:.0f} ms for both runs")
+
+
+# OldTweetGetter.get_old_tweets against the fake search endpoint with no rate limit, writing csv chunk files to a
+# temporary directory: pages parsed and written by the fetching threads versus by a BackfillProcessPool. The speedup
+# is bounded by the number of CPUs.
+def bench_backfill(pages=40, workers=4):
+    import os
+    from GetOldTweets import OldTweetGetter
+    from ChunkSink import ChunkSink
+    from BackfillProcessPool import chunk_sink
+    from RateLimiter import RateLimiter
+    from TweetDeduplicator import TweetDeduplicator
+    from ProfileCache import ProfileCache
+
+    search_pages = make_search_pages(pages, 500)
+    for processes in sorted({0, 2, os.cpu_count() or 1}):
+        with tempfile.TemporaryDirectory() as directory:
+            sink = ChunkSink("csv", directory) if not processes else None
+            getter = OldTweetGetter(['vaping', 'juul'], ProfileCache(), TweetDeduplicator(), sink,
+                                    api=FakeTwitterAPI(search_pages=search_pages),
+                                    keyword_ids={'vaping': 1, 'juul': 2})
+            getter.search_rate_limiter = RateLimiter(max_requests=10 ** 9, window=900.0, min_interval=0.0)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                getter.get_old_tweets('2020-03-05T06:43:25Z', '2020-03-06T06:43:25Z', workers=workers,
+                                      processes=processes,
+                                      sink_factory=functools.partial(chunk_sink, directory=directory))
+                if sink is not None:
+                    sink.close()
+            elapsed = time.perf_counter() - start
+        name = f"{processes} processes" if processes else "threads only"
+        print(f"Backfill, {name}: {pages / elapsed:,.1f} pages/sec ({os.cpu_count()} CPUs)")
+
+
+# Time to start a fresh interpreter and run code, best of repeat runs. The last line printed by code is returned too.
+def startup_time(code, repeat=5):
+    best = float('inf')
+    output = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        best = min(best, time.perf_counter() - start)
+        output = result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ""
+    return best, output
+
+
+# Startup of the two entry points up to the point where they start talking to Twitter: importing TwitterStream, and
+# importing GetOldTweets and creating an OldTweetGetter. Prints whether pandas was loaded on the way.
+def bench_startup():
+    baseline, _ = startup_time("pass")
+    pandas, _ = startup_time("import pandas")
+    print(f"Startup: interpreter {baseline * 1000:.0f} ms, import pandas {pandas * 1000:.0f} ms")
+    entry_points = {
+        'TwitterStream': "import sys, TwitterStream; print('pandas' in sys.modules)",
+        'OldTweetGetter': "import sys, GetOldTweets, FakeTwitterAPI; "
+                          "GetOldTweets.OldTweetGetter(['covid', 'vaccine'], api=FakeTwitterAPI.FakeTwitterAPI()); "
+                          "print('pandas' in sys.modules)",
+    }
+    for name, code in entry_points.items():
+        elapsed, pandas_loaded = startup_time(code)
+        print(f"Startup, {name}: {elapsed * 1000:.0f} ms, pandas loaded: {pandas_loaded}")
+
+
+def main():
+    bench_startup()
+    bench_wrapper()
+    bench_stream_decode()
+    bench_batch_memory()
+    bench_query_packing()
+    bench_keyword_matching()
+    bench_db_writes()
+    bench_stream()
+    bench_backfill_executor()
+    bench_backfill_retry()
+    bench_backfill()
+
+
+if __name__ == "__main__":
+    main()